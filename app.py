@@ -1,18 +1,49 @@
 # @redears-lambda TODO: create dummy items, transactions, and likes
 from base64 import encode
 from encodings import utf_8
+import csv
+import gzip
+import heapq
+import hmac
+import io
 import json
-from datetime import datetime
+import math
+import mimetypes
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
 from uuid import uuid4
 from passlib.hash import pbkdf2_sha256
 import hashlib
+from threading import BoundedSemaphore, Lock, Thread
 
+import click
 from flask_mail import Mail, Message
 import numpy as np
-import pandas as pd
 import plotly
 import plotly.graph_objects as go
-from flask import Flask, jsonify, redirect, render_template, request, url_for
+from flask import (
+    Flask,
+    g,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    stream_with_context,
+    url_for,
+)
 from flask_bootstrap import Bootstrap5
 from flask_login import (
     LoginManager,
@@ -26,9 +57,30 @@ from flask_msearch import Search
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileAllowed, FileField, FileRequired
-from PIL import Image
+from markupsafe import Markup
+from PIL import Image, ImageOps
 from plotly.utils import PlotlyJSONEncoder
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import InvalidRequestError, OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
+
+try:
+    import brotli
+except ImportError:  # NOTE : optional, only gzip variants are built without it
+    brotli = None
+try:
+    import orjson
+except ImportError:  # NOTE : optional, the api falls back to the json module
+    orjson = None
+try:
+    import redis
+except ImportError:  # NOTE : optional, only needed for a shared fragment cache
+    redis = None
 from wtforms import (
     BooleanField,
     EmailField,
@@ -51,6 +103,23 @@ Bootstrap5(app)
 app.config["SECRET_KEY"] = "secret"
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# NOTE : flask_sqlalchemy falls back to NullPool for sqlite files, which opens a
+# fresh connection (and reruns the pragmas below) on every checkout
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "poolclass": QueuePool,
+    "pool_size": 8,
+    "max_overflow": 8,
+    "connect_args": {"check_same_thread": False, "timeout": 15},
+}
+# NOTE : WAL lets readers run alongside a writer, synchronous=NORMAL is still
+# durable against application crashes under WAL
+app.config["SQLITE_PRAGMAS"] = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -64 * 1024,  # KiB per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 15000,  # ms
+}
 app.config["MAIL_SERVER"] = "smtp.gmail.com"
 app.config["MAIL_PORT"] = 465
 app.config["MAIL_USE_TLS"] = False
@@ -59,23 +128,219 @@ app.config["MAIL_USERNAME"] = "fishe8861@gmail.com"
 app.config["MAIL_PASSWORD"] = "fishe87654321"
 app.config["MAIL_SUPPRESS_SEND"] = False
 app.config["TESTING"] = False
+app.config["MAIL_OUTBOX_INTERVAL"] = 5  # seconds, 0 disables the sender
+app.config["MAIL_BATCH_SIZE"] = 50
+app.config["MAIL_MAX_ATTEMPTS"] = 5
+app.config["MAIL_RETRY_DELAY"] = 30  # seconds, doubled after every failure
+app.config["PASSWORD_WORKERS"] = 2
+app.config["PASSWORD_QUEUE_DEPTH"] = 32  # hashes queued or running at once
+app.config["PASSWORD_QUEUE_TIMEOUT"] = 2  # seconds to wait for a free slot
+app.config["PASSWORD_ROUNDS"] = 29000  # pbkdf2_sha256 rounds for new hashes
+app.config["PAGE_SIZE"] = 24
+app.config["RECOMMENDATION_SIZE"] = 8
+app.config["RECOMMENDATION_NEIGHBOURS"] = 20
+app.config["SIMILAR_ITEMS"] = 4  # shown on the item page
+app.config["FEED_SIZE"] = 200
+app.config["FEED_FANOUT_LIMIT"] = 1000  # vendors with more followers are pulled on read
+app.config["FEATURED_SIZE"] = 12
+app.config["FEATURED_RANK_INTERVAL"] = 10 * 60  # seconds, 0 disables the ranker
+app.config["FEATURED_LIKE_WINDOW_DAYS"] = 7
+app.config["FEATURED_HALF_LIFE_DAYS"] = 7
+app.config["IMAGE_WORKERS"] = 2
+app.config["IMAGE_WIDTHS"] = (250, 800)  # card and detail variants
+app.config["IMAGE_MAX_AGE"] = 365 * 24 * 60 * 60  # seconds, for hashed images
+app.config["ASSET_MAX_AGE"] = 365 * 24 * 60 * 60  # seconds, for fingerprinted assets
+app.config["FIGURE_CACHE_SIZE"] = 256
+app.config["SEARCH_RESULTS_SIZE"] = 1024
+app.config["SEARCH_RESULTS_TTL"] = 30 * 60  # seconds
+app.config["USER_CACHE_SIZE"] = 4096
+app.config["USER_CACHE_TTL"] = 60  # seconds, bounds staleness across processes
+app.config["FRAGMENT_CACHE_SIZE"] = 4096
+app.config["FRAGMENT_CACHE_URL"] = None  # e.g. "redis://localhost:6379/0" to share
+app.config["FRAGMENT_CACHE_TTL"] = 24 * 60 * 60  # seconds, shared backend only
+# NOTE : without FRAGMENT_CACHE_URL fragments are only cached under TESTING or
+# when this is set, and only a single process may then write to the database
+app.config["FRAGMENT_CACHE_LOCAL"] = False
+app.config["API_MAX_IDS"] = 100  # per batch request
+app.config["EXPORT_BATCH_SIZE"] = 1000  # rows fetched and written per chunk
 # app.config["WHOOSH_BASE"] = "whoosh"
+app.config["SEARCH_BACKEND"] = "fts5"  # "fts5" or "whoosh"
+# NOTE : flask_msearch falls back to its unindexed "simple" backend unless told
+# otherwise. the index only tracks commits while it is in use, see bench-search
+app.config["MSEARCH_BACKEND"] = "whoosh"
+app.config["MSEARCH_ENABLE"] = app.config["SEARCH_BACKEND"] == "whoosh"
 db = SQLAlchemy(app, session_options={"expire_on_commit": False})
 login_manager = LoginManager(app)
 search = Search(app, db)
 mail = Mail(app)
 
 
+@event.listens_for(Engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config["SQLITE_PRAGMAS"].items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+######## PASSWORDS ########
+
+# NOTE : pbkdf2 is CPU bound, so hashing and verifying run on a process pool
+# instead of tying up request threads on the GIL. at most PASSWORD_QUEUE_DEPTH
+# jobs are in flight, past that requests fail fast with a 503
+
+
+class PasswordQueueFull(Exception):
+    pass
+
+
+def timed_hash(password, rounds):
+    started = time.perf_counter()
+    password_hash = pbkdf2_sha256.using(rounds=rounds).hash(password)
+    return password_hash, time.perf_counter() - started
+
+
+def timed_verify(password, password_hash):
+    started = time.perf_counter()
+    if pbkdf2_sha256.identify(password_hash):
+        valid = pbkdf2_sha256.verify(password, password_hash)
+    else:
+        # NOTE : rows older than password hashing store the plain password,
+        # they are rehashed on login and by upgrade-db
+        valid = hmac.compare_digest(password.encode(), password_hash.encode())
+    return valid, time.perf_counter() - started
+
+
+class PasswordPool:
+    """Bounded process pool for password hashing with timing counters."""
+
+    def __init__(self, workers, queue_depth, queue_timeout):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self.slots = BoundedSemaphore(queue_depth)
+        self.lock = Lock()
+        self.executor = None
+        self.completed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+
+    def submit(self, job, *args):
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            with self.lock:
+                self.rejected += 1
+            raise PasswordQueueFull()
+        started = time.perf_counter()
+        try:
+            with self.lock:
+                executor = self.get_executor()
+                self.in_flight += 1
+            result, run_time = executor.submit(job, *args).result()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.completed += 1
+            self.run_time += run_time
+            self.wait_time += elapsed - run_time
+        return result
+
+    def get_executor(self):
+        # NOTE : created lazily so cli commands don't start workers, spawned
+        # since forking a threaded server copies held locks. callers hold lock
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self.executor
+
+    def warm_up(self):
+        """Start every worker now instead of on the first logins."""
+        with self.lock:
+            executor = self.get_executor()
+        # NOTE : no worker is idle while these are queued, so each one spawns
+        # another worker until the pool is full
+        jobs = [
+            executor.submit(timed_hash, "warm up", 1000) for _ in range(self.workers)
+        ]
+        for job in jobs:
+            job.result()
+
+    def stats(self):
+        with self.lock:
+            completed = self.completed or 1
+            return {
+                "workers": self.workers,
+                "queue_depth": self.queue_depth,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "average_wait": self.wait_time / completed,
+                "average_run": self.run_time / completed,
+            }
+
+
+password_pool = PasswordPool(
+    app.config["PASSWORD_WORKERS"],
+    app.config["PASSWORD_QUEUE_DEPTH"],
+    app.config["PASSWORD_QUEUE_TIMEOUT"],
+)
+
+
+def hash_password(password):
+    return password_pool.submit(timed_hash, password, app.config["PASSWORD_ROUNDS"])
+
+
+def verify_password(password, password_hash):
+    return password_pool.submit(timed_verify, password, password_hash)
+
+
+def is_password_hashed(password_hash):
+    return pbkdf2_sha256.identify(password_hash)
+
+
+@app.errorhandler(PasswordQueueFull)
+def password_queue_full(error):
+    message = "The server is busy, please try again shortly."
+    return message, 503, {"Retry-After": "5"}
+
+
 ######## LOGIN MANAGER ########
 
 
+# NOTE : every request used to pay a primary key lookup just to rebuild
+# current_user. loaded users are kept in a per process cache and merged into
+# the request session without touching the database. routes that change a
+# user's profile or password drop the entry, anything else (counters, follower
+# counts) is allowed to go stale for at most USER_CACHE_TTL seconds
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        user_cache.set(user_id, user)
+    try:
+        return db.session.merge(user, load=False)
+    except InvalidRequestError:
+        # NOTE : the cached copy picked up unflushed changes, reload it
+        user_cache.delete(user_id)
+        return User.query.get(user_id)
 
 
 @login_manager.unauthorized_handler
 def unauthorized_callback():
+    if request.path.startswith(API_PREFIX):
+        return api_response({"error": "login required"}, 401)
     return redirect(url_for("render_login"))
 
 
@@ -89,9 +354,22 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(20), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     description = db.Column(db.String(500), nullable=True)
-    image_file = db.Column(db.String(20), nullable=False, default="default.jpg")
-    password = db.Column(db.String(60), nullable=False)
+    image_file = db.Column(db.String(200), nullable=False, default="default.jpg")
+    password = db.Column(db.String(128), nullable=False)
     date_joined = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # NOTE : feeds the Last-Modified of profile pages, empty for rows older than
+    # the column, readers fall back to date_joined
+    date_modified = db.Column(
+        db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+    # NOTE : reputation counters, kept in step by record_review/record_sale
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    sold_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    revenue = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    follower_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
     items = db.relationship("Item", backref="author", lazy=True)
     bought = db.relationship(
         "Transaction", foreign_keys="Transaction.user_id", backref="buyer", lazy=True
@@ -120,130 +398,1532 @@ class User(db.Model, UserMixin):
 
     @property
     def ratings(self):
-        return len(self.reviewed)
+        return self.review_count
 
     @property
     def rating(self):
-        total = 0
-        reviews = self.reviewed
-        if reviews:
-            for review in reviews:
-                total += review.rating
-            average = total / len(self.reviewed)
+        if self.review_count:
+            average = self.rating_sum / self.review_count
             return "{:.1f}".format(average)
         return "No reviews yet"
 
     def __repr__(self):
         return f"User(username='{self.username}',email='{self.email}',image_file='{self.image_file}')"
 
+    @property
+    def liked_item_ids(self):
+        # NOTE : loaded once per request so item cards don't each query ItemLike
+        liked_item_ids = g.setdefault("liked_item_ids", {})
+        if self.id not in liked_item_ids:
+            rows = db.session.query(ItemLike.item_id).filter(
+                ItemLike.user_id == self.id
+            )
+            liked_item_ids[self.id] = {item_id for (item_id,) in rows}
+        return liked_item_ids[self.id]
+
+    @property
+    def followed_user_ids(self):
+        # NOTE : loaded once per request, like liked_item_ids
+        followed_user_ids = g.setdefault("followed_user_ids", {})
+        if self.id not in followed_user_ids:
+            rows = db.session.query(UserFollow.recipient_id).filter(
+                UserFollow.user_id == self.id
+            )
+            followed_user_ids[self.id] = {user_id for (user_id,) in rows}
+        return followed_user_ids[self.id]
+
     def like_item(self, item):
-        if not self.has_liked_item(item):
-            like = ItemLike(user_id=self.id, item_id=item.id)
-            db.session.add(like)
+        self.like_items([item.id])
 
     def unlike_item(self, item):
-        if self.has_liked_item(item):
-            ItemLike.query.filter_by(user_id=self.id, item_id=item.id).delete()
+        self.unlike_items([item.id])
+
+    def like_items(self, item_ids):
+        # NOTE : bulk path, one statement per table whatever the number of
+        # items. the caller checks the items exist and commits
+        new_ids = set(item_ids) - self.liked_item_ids
+        if new_ids:
+            db.session.execute(
+                db.insert(ItemLike),
+                [{"user_id": self.id, "item_id": item_id} for item_id in new_ids],
+            )
+            stage_fragment_changes(("item", item_id) for item_id in new_ids)
+            self.liked_item_ids.update(new_ids)
+        return new_ids
 
-    def has_liked_item(self, item):
-        return (
+    def unlike_items(self, item_ids):
+        old_ids = set(item_ids) & self.liked_item_ids
+        if old_ids:
             ItemLike.query.filter(
-                ItemLike.user_id == self.id, ItemLike.item_id == item.id
-            ).count()
-            > 0
-        )
+                ItemLike.user_id == self.id, ItemLike.item_id.in_(old_ids)
+            ).delete(synchronize_session=False)
+            stage_fragment_changes(("item", item_id) for item_id in old_ids)
+            self.liked_item_ids.difference_update(old_ids)
+        return old_ids
+
+    def has_liked_item(self, item):
+        return item.id in self.liked_item_ids
 
     def follow_user(self, user):
-        if not self.has_followed_user(user):
-            follow = UserFollow(user_id=self.id, recipient_id=user.id)
-            db.session.add(follow)
+        self.follow_users([user])
 
     def unfollow_user(self, user):
-        if self.has_followed_user(user):
-            UserFollow.query.filter_by(user_id=self.id, recipient_id=user.id).delete()
+        self.unfollow_users([user])
+
+    def follow_users(self, users):
+        # NOTE : bulk path, one statement per table whatever the number of users
+        users = [user for user in users if user.id not in self.followed_user_ids]
+        if not users:
+            return []
+        user_ids = [user.id for user in users]
+        db.session.execute(
+            db.insert(UserFollow),
+            [{"user_id": self.id, "recipient_id": user_id} for user_id in user_ids],
+        )
+        stage_fragment_changes(("user", user_id) for user_id in [self.id, *user_ids])
+        User.query.filter(User.id.in_(user_ids)).update(
+            {User.follower_count: User.follower_count + 1}
+        )
+        self.touch()
+        self.followed_user_ids.update(user_ids)
+        backfill_feed(self, users)
+        return users
+
+    def unfollow_users(self, users):
+        users = [user for user in users if user.id in self.followed_user_ids]
+        if not users:
+            return []
+        user_ids = [user.id for user in users]
+        UserFollow.query.filter(
+            UserFollow.user_id == self.id, UserFollow.recipient_id.in_(user_ids)
+        ).delete(synchronize_session=False)
+        stage_fragment_changes(("user", user_id) for user_id in [self.id, *user_ids])
+        User.query.filter(User.id.in_(user_ids)).update(
+            {User.follower_count: User.follower_count - 1}
+        )
+        self.touch()
+        self.followed_user_ids.difference_update(user_ids)
+        FeedEntry.query.filter(
+            FeedEntry.user_id == self.id, FeedEntry.vendor_id.in_(user_ids)
+        ).delete(synchronize_session=False)
+        return users
+
+    def touch(self):
+        # NOTE : the following list on a profile has no timestamp of its own
+        User.query.filter_by(id=self.id).update({User.date_modified: datetime.utcnow()})
 
     def has_followed_user(self, user):
-        return (
-            UserFollow.query.filter(
-                UserFollow.user_id == self.id, UserFollow.recipient_id == user.id
-            ).count()
-            > 0
-        )
+        return user.id in self.followed_user_ids
 
 
 class Item(db.Model):
     __searchable__ = ["name", "description"]
 
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    name = db.Column(db.String(100), nullable=False)
-    description = db.Column(db.String(500), nullable=False)
-    category = db.Column(db.String(20), nullable=True)
-    base_price = db.Column(db.Float, nullable=False)
-    image_file = db.Column(db.String(200), nullable=False, default="default.jpg")
-    date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    likes = db.relationship("ItemLike", backref="item", lazy=True)
-    status = db.Column(
-        db.String(10), nullable=False, default="available"
-    )  # "available" or "sold"
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    name = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.String(500), nullable=False)
+    category = db.Column(db.String(20), nullable=True)
+    base_price = db.Column(db.Float, nullable=False)
+    image_file = db.Column(db.String(200), nullable=False, default="default.jpg")
+    date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    date_modified = db.Column(
+        db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+    likes = db.relationship("ItemLike", backref="item", lazy=True)
+    # NOTE : serve /browse filters and sorts with index scans
+    __table_args__ = (
+        db.Index("ix_item_status_category_price", "status", "category", "base_price"),
+        db.Index("ix_item_status_date_posted", "status", "date_posted"),
+    )
+    status = db.Column(
+        db.String(10), nullable=False, default="available"
+    )  # "available" or "sold"
+
+    @property
+    def price(self):
+        return "{:.2f}".format(self.base_price)
+
+    def format_date_difference(self):
+        days = (datetime.utcnow() - self.date_posted).days
+        if days <= 0:
+            return "today"
+        if days == 1:
+            return "yesterday"
+        return f"{days} days ago"
+
+    def __repr__(self):
+        return f"Item(name='{self.name}',date_posted='{self.date_posted}',image_file='{self.image_file}')"
+
+
+class Review(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    transaction_id = db.Column(
+        db.Integer, db.ForeignKey("transaction.id"), nullable=False, index=True
+    )
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    recipient_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    rating = db.Column(db.Integer, nullable=False)
+    comment = db.Column(db.String(500), nullable=False)
+
+    def __repr__(self):
+        return f"Review(user_id={self.user_id},recipient_id={self.recipient_id},rating={self.rating},comment='{self.comment}')"
+
+
+class ItemLike(db.Model):
+    __table_args__ = (db.Index("ix_item_like_user_item", "user_id", "item_id"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    item_id = db.Column(
+        db.Integer, db.ForeignKey("item.id"), nullable=False, index=True
+    )
+    date_liked = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"ItemLike(user_id={self.user_id},item_id={self.item_id})"
+
+
+class UserFollow(db.Model):
+    __table_args__ = (
+        db.Index("ix_user_follow_user_recipient", "user_id", "recipient_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    recipient_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+
+    def __repr__(self):
+        return f"UserFollow(user_id={self.user_id},recipient_id={self.recipient_id})"
+
+
+class Transaction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    item_id = db.Column(
+        db.Integer, db.ForeignKey("item.id"), nullable=False, index=True
+    )
+    vendor_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    value = db.Column(db.Float, nullable=False)
+    date_transacted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Transaction(user_id={self.user_id},vendor_id={self.vendor_id},item_id={self.item_id},value={self.value},date_transacted='{self.date_transacted}')"
+
+
+class FeedEntry(db.Model):
+    # NOTE : one row per listing in a follower's timeline, see fan_out_item
+    __table_args__ = (
+        db.Index("ix_feed_entry_user_date_item", "user_id", "date_posted", "item_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    item_id = db.Column(
+        db.Integer, db.ForeignKey("item.id"), nullable=False, index=True
+    )
+    vendor_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    date_posted = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"FeedEntry(user_id={self.user_id},item_id={self.item_id},vendor_id={self.vendor_id})"
+
+
+class FeaturedItem(db.Model):
+    # NOTE : ranked snapshot written by rank_featured_items, read by /home
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(
+        db.Integer, db.ForeignKey("item.id"), nullable=False, index=True
+    )
+    score = db.Column(db.Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"FeaturedItem(item_id={self.item_id},score={self.score})"
+
+
+class SalesRollup(db.Model):
+    # NOTE : one row per vendor, category and day, see record_sale_rollup
+    __table_args__ = (db.UniqueConstraint("vendor_id", "category", "day"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    vendor_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    category = db.Column(db.String(20), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def average_price(self):
+        return self.revenue / self.units if self.units else 0
+
+    def __repr__(self):
+        return f"SalesRollup(vendor_id={self.vendor_id},category='{self.category}',day='{self.day}',revenue={self.revenue},units={self.units})"
+
+
+class ItemSimilarity(db.Model):
+    # NOTE : top neighbours of every item, written by rebuild_recommendations
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(
+        db.Integer, db.ForeignKey("item.id"), nullable=False, index=True
+    )
+    similar_item_id = db.Column(
+        db.Integer, db.ForeignKey("item.id"), nullable=False, index=True
+    )
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f"ItemSimilarity(item_id={self.item_id},similar_item_id={self.similar_item_id},score={self.score})"
+
+
+class Recommendation(db.Model):
+    # NOTE : precomputed top items for every user, read as-is on page views
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    item_id = db.Column(
+        db.Integer, db.ForeignKey("item.id"), nullable=False, index=True
+    )
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f"Recommendation(user_id={self.user_id},item_id={self.item_id},score={self.score})"
+
+
+class OutboxMail(db.Model):
+    # NOTE : mail waiting for send_outbox, sent_at stays empty until delivered
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    sender = db.Column(db.String(120), nullable=False)
+    recipients = db.Column(db.String(500), nullable=False)  # comma separated
+    body = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
+    claim = db.Column(db.String(32), nullable=True)
+    last_error = db.Column(db.String(500), nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    def to_message(self):
+        return Message(
+            subject=self.subject,
+            sender=self.sender,
+            recipients=self.recipients.split(","),
+            body=self.body,
+        )
+
+    def __repr__(self):
+        return f"OutboxMail(subject='{self.subject}',recipients='{self.recipients}',attempts={self.attempts},sent_at='{self.sent_at}')"
+
+
+class PasswordPin(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    pin = db.Column(db.Integer, nullable=False)
+
+
+######## CACHES ########
+
+
+class LRUCache:
+    """Thread safe in-process LRU cache with an optional TTL and hit/miss counters."""
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0,
+            }
+
+
+user_cache = LRUCache(
+    app.config["USER_CACHE_SIZE"], ttl=app.config["USER_CACHE_TTL"]
+)
+
+
+# NOTE : rendered template fragments are keyed by the version of every entity
+# they show. a commit that touches an entity bumps its version, so stale
+# fragments are never looked up again and simply age out of the cache
+
+
+class NullFragmentBackend:
+    """Caches nothing, used when versions can't be shared between processes."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, html):
+        pass
+
+    def get_versions(self, entities):
+        return [0] * len(entities)
+
+    def bump(self, entities):
+        pass
+
+
+class LocalFragmentBackend:
+    """Per process fragment store, versions are not shared between workers."""
+
+    def __init__(self, max_entries):
+        self.fragments = LRUCache(max_entries)
+        self.versions = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        return self.fragments.get(key)
+
+    def set(self, key, html):
+        self.fragments.set(key, html)
+
+    def get_versions(self, entities):
+        with self.lock:
+            return [self.versions.get(entity, 0) for entity in entities]
+
+    def bump(self, entities):
+        with self.lock:
+            for entity in entities:
+                self.versions[entity] = self.versions.get(entity, 0) + 1
+
+
+class RedisFragmentBackend:
+    """Fragment store shared by every worker through redis."""
+
+    def __init__(self, url, ttl):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    @staticmethod
+    def fragment_key(key):
+        return "fragment:" + hashlib.sha1(repr(key).encode()).hexdigest()
+
+    @staticmethod
+    def version_key(entity):
+        return "fragment-version:{}:{}".format(*entity)
+
+    def get(self, key):
+        html = self.client.get(self.fragment_key(key))
+        return html.decode() if html is not None else None
+
+    def set(self, key, html):
+        self.client.set(self.fragment_key(key), html, ex=self.ttl)
+
+    def get_versions(self, entities):
+        if not entities:
+            return []
+        versions = self.client.mget([self.version_key(entity) for entity in entities])
+        return [int(version or 0) for version in versions]
+
+    def bump(self, entities):
+        pipeline = self.client.pipeline()
+        for entity in entities:
+            pipeline.incr(self.version_key(entity))
+        pipeline.execute()
+
+
+class FragmentCache:
+    """Versioned fragment cache with per fragment hit and render time stats."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = Lock()
+        self.fragments = {}
+
+    def render(self, name, entities, variant, render):
+        versions = self.backend.get_versions(entities)
+        key = (name, variant) + tuple(zip(entities, versions))
+        html = self.backend.get(key)
+        hit = html is not None
+        elapsed = 0
+        if not hit:
+            started = time.perf_counter()
+            html = str(render())
+            elapsed = time.perf_counter() - started
+            self.backend.set(key, html)
+        with self.lock:
+            stats = self.fragments.setdefault(
+                name, {"hits": 0, "misses": 0, "render_seconds": 0}
+            )
+            if hit:
+                stats["hits"] += 1
+            else:
+                stats["misses"] += 1
+                stats["render_seconds"] += elapsed
+        return Markup(html)
+
+    def invalidate(self, entities):
+        if entities:
+            self.backend.bump(entities)
+
+    def stats(self):
+        with self.lock:
+            report = {}
+            for name, stats in self.fragments.items():
+                lookups = stats["hits"] + stats["misses"]
+                render_ms = (
+                    stats["render_seconds"] * 1000 / stats["misses"]
+                    if stats["misses"]
+                    else 0
+                )
+                report[name] = {
+                    "hits": stats["hits"],
+                    "misses": stats["misses"],
+                    "hit_ratio": stats["hits"] / lookups if lookups else 0,
+                    "render_ms": render_ms,
+                    "saved_ms": stats["hits"] * render_ms,
+                }
+            return report
+
+
+def make_fragment_backend():
+    if app.config["FRAGMENT_CACHE_URL"] and redis is not None:
+        return RedisFragmentBackend(
+            app.config["FRAGMENT_CACHE_URL"], app.config["FRAGMENT_CACHE_TTL"]
+        )
+    # NOTE : local versions only move on this process's commits. other workers
+    # and cli jobs (make-image-variants, rebuild-*) would leave stale fragments
+    # cached, so local mode is opt in for single process setups
+    if app.config["FRAGMENT_CACHE_LOCAL"] or app.config["TESTING"]:
+        return LocalFragmentBackend(app.config["FRAGMENT_CACHE_SIZE"])
+    return NullFragmentBackend()
+
+
+fragment_cache = FragmentCache(make_fragment_backend())
+
+FRAGMENT_ENTITY_KINDS = {Item: "item", Review: "review", User: "user"}
+
+# NOTE : which cached entities a committed row change makes stale
+FRAGMENT_DEPENDENCIES = {
+    Item: lambda item: [("item", item.id)],
+    Review: lambda review: [("review", review.id)],
+    User: lambda user: [("user", user.id)],
+    ItemLike: lambda like: [("item", like.item_id)],
+    Transaction: lambda transaction: [("item", transaction.item_id)],
+    UserFollow: lambda follow: [
+        ("user", follow.user_id),
+        ("user", follow.recipient_id),
+    ],
+}
+
+
+@event.listens_for(Session, "after_flush")
+def collect_fragment_changes(session, flush_context):
+    changed = session.info.setdefault("fragment_entities", set())
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        dependencies = FRAGMENT_DEPENDENCIES.get(type(instance))
+        if dependencies is not None:
+            changed.update(dependencies(instance))
+
+
+def stage_fragment_changes(entities):
+    # NOTE : bulk statements never reach the flush, their callers stage here
+    db.session.info.setdefault("fragment_entities", set()).update(entities)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_fragments(session):
+    fragment_cache.invalidate(session.info.pop("fragment_entities", None))
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_fragment_changes(session, previous_transaction):
+    session.info.pop("fragment_entities", None)
+
+
+@app.template_global()
+def cached_fragment(name, *instances, variant=None, caller=None):
+    """Render the enclosing {% call %} block once per version of instances."""
+    entities = [
+        (FRAGMENT_ENTITY_KINDS[type(instance)], instance.id) for instance in instances
+    ]
+    return fragment_cache.render(name, entities, variant, caller)
+
+
+@app.template_global()
+def like_state(items):
+    # NOTE : fragment variant for the like buttons of the current viewer
+    if not current_user.is_authenticated:
+        return "anon"
+    liked_item_ids = current_user.liked_item_ids
+    return "".join("1" if item.id in liked_item_ids else "0" for item in items)
+
+
+######## QUERIES ########
+
+# NOTE : every helper here runs a fixed number of queries no matter how many
+# reviews, follows, transactions or likes the user has. listings are keyset
+# paginated newest first and return (rows, next_cursor)
+
+
+def encode_cursor(values):
+    return "_".join(
+        value.isoformat() if isinstance(value, datetime) else str(value)
+        for value in values
+    )
+
+
+def decode_cursor_value(value):
+    for parse in (int, float, datetime.fromisoformat):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    raise ValueError(f"invalid cursor value {value!r}")
+
+
+def decode_cursor(cursor):
+    return tuple(decode_cursor_value(value) for value in cursor.split("_"))
+
+
+def paginate(query, columns, cursor=None, page_size=None, descending=True):
+    page_size = page_size or app.config["PAGE_SIZE"]
+    if cursor:
+        values = db.tuple_(
+            *[db.literal(value, column.type) for column, value in zip(columns, cursor)]
+        )
+        keys = db.tuple_(*columns)
+        query = query.filter(keys < values if descending else keys > values)
+    order = [column.desc() if descending else column.asc() for column in columns]
+    rows = query.add_columns(*columns).order_by(*order).limit(page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        next_cursor = encode_cursor(rows[page_size - 1][1:])
+    return [row[0] for row in rows[:page_size]], next_cursor
+
+
+def get_liked_items(user, cursor=None, page_size=None):
+    query = Item.query.join(ItemLike, ItemLike.item_id == Item.id).filter(
+        ItemLike.user_id == user.id
+    )
+    return paginate(query, (Item.date_posted, Item.id), cursor, page_size)
+
+
+def get_listed_items(user, cursor=None, page_size=None):
+    query = Item.query.filter_by(user_id=user.id, status="available")
+    return paginate(query, (Item.date_posted, Item.id), cursor, page_size)
+
+
+def get_bought_items(user, cursor=None, page_size=None):
+    query = Item.query.join(Transaction, Transaction.item_id == Item.id).filter(
+        Transaction.user_id == user.id
+    )
+    return paginate(query, (Item.date_posted, Item.id), cursor, page_size)
+
+
+def get_sold_items(user, cursor=None, page_size=None):
+    query = Item.query.join(Transaction, Transaction.item_id == Item.id).filter(
+        Transaction.vendor_id == user.id
+    )
+    return paginate(query, (Item.date_posted, Item.id), cursor, page_size)
+
+
+def get_following(user, cursor=None, page_size=None):
+    query = User.query.join(UserFollow, UserFollow.recipient_id == User.id).filter(
+        UserFollow.user_id == user.id
+    )
+    return paginate(query, (UserFollow.id,), cursor, page_size)
+
+
+def get_followers(user, cursor=None, page_size=None):
+    query = User.query.join(UserFollow, UserFollow.user_id == User.id).filter(
+        UserFollow.recipient_id == user.id
+    )
+    return paginate(query, (UserFollow.id,), cursor, page_size)
+
+
+BROWSE_SORTS = {
+    "newest": ((Item.date_posted, Item.id), True),
+    "price_low": ((Item.base_price, Item.id), False),
+    "price_high": ((Item.base_price, Item.id), True),
+}
+
+
+def filter_browse(query, min_price=None, max_price=None):
+    query = query.filter(Item.status == "available")
+    if min_price is not None:
+        query = query.filter(Item.base_price >= min_price)
+    if max_price is not None:
+        query = query.filter(Item.base_price <= max_price)
+    return query
+
+
+def browse_items(
+    category=None, min_price=None, max_price=None, sort="newest", cursor=None
+):
+    query = filter_browse(Item.query, min_price, max_price)
+    if category:
+        query = query.filter(Item.category == category)
+    columns, descending = BROWSE_SORTS[sort]
+    return paginate(query, columns, cursor, descending=descending)
+
+
+def count_browse_facets(min_price=None, max_price=None):
+    # NOTE : counts ignore the chosen category so every facet stays clickable
+    query = db.session.query(Item.category, db.func.count(Item.id)).group_by(
+        Item.category
+    )
+    return dict(filter_browse(query, min_price, max_price).all())
+
+
+def get_reviews(user, cursor=None, page_size=None):
+    # returns (author, review) pairs, the shape render_review/review_card expect
+    query = Review.query.options(db.joinedload(Review.author)).filter(
+        Review.recipient_id == user.id
+    )
+    reviews, next_cursor = paginate(
+        query, (Review.date_posted, Review.id), cursor, page_size
+    )
+    return [(review.author, review) for review in reviews], next_cursor
+
+
+@app.template_global()
+def next_page_url(name, cursor):
+    args = request.args.to_dict()
+    args[name] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+######## REPUTATION ########
+
+# NOTE : these only stage the update, the caller commits it together with the
+# review or transaction that caused it
+
+
+def record_review(recipient_id, rating):
+    User.query.filter_by(id=recipient_id).update(
+        {
+            User.review_count: User.review_count + 1,
+            User.rating_sum: User.rating_sum + rating,
+        }
+    )
+
+
+def record_sale(vendor_id, value):
+    User.query.filter_by(id=vendor_id).update(
+        {
+            User.sold_count: User.sold_count + 1,
+            User.revenue: User.revenue + value,
+        }
+    )
+
+
+def rebuild_reputation():
+    def total(expression, *criteria):
+        return (
+            db.select(db.func.coalesce(expression, 0))
+            .where(*criteria)
+            .scalar_subquery()
+        )
+
+    User.query.update(
+        {
+            User.review_count: total(
+                db.func.count(Review.id), Review.recipient_id == User.id
+            ),
+            User.rating_sum: total(
+                db.func.sum(Review.rating), Review.recipient_id == User.id
+            ),
+            User.sold_count: total(
+                db.func.count(Transaction.id), Transaction.vendor_id == User.id
+            ),
+            User.revenue: total(
+                db.func.sum(Transaction.value), Transaction.vendor_id == User.id
+            ),
+            User.follower_count: total(
+                db.func.count(UserFollow.id), UserFollow.recipient_id == User.id
+            ),
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+
+######## ANALYTICS ########
+
+# NOTE : the dashboard only reads SalesRollup, so its cost follows the number of
+# days/categories rather than the number of sales
+
+BUCKET_FORMATS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def record_sale_rollup(vendor_id, category, value, day):
+    # NOTE : staged only, committed together with the transaction
+    statement = sqlite_insert(SalesRollup).values(
+        vendor_id=vendor_id,
+        category=category or "Other",
+        day=day,
+        revenue=value,
+        units=1,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["vendor_id", "category", "day"],
+        set_={
+            "revenue": SalesRollup.revenue + statement.excluded.revenue,
+            "units": SalesRollup.units + statement.excluded.units,
+        },
+    )
+    db.session.execute(statement)
+
+
+def rebuild_sales_rollups():
+    day = db.func.date(Transaction.date_transacted)
+    category = db.func.coalesce(Item.category, "Other")
+    rows = (
+        db.select(
+            Transaction.vendor_id,
+            category,
+            day,
+            db.func.sum(Transaction.value),
+            db.func.count(Transaction.id),
+        )
+        .join_from(Transaction, Item, Item.id == Transaction.item_id)
+        .group_by(Transaction.vendor_id, category, day)
+    )
+    SalesRollup.query.delete()
+    db.session.execute(
+        db.insert(SalesRollup).from_select(
+            ["vendor_id", "category", "day", "revenue", "units"], rows
+        )
+    )
+    db.session.commit()
+
+
+figure_cache = LRUCache(app.config["FIGURE_CACHE_SIZE"])
+
+
+def build_analytics_figures(vendor_id, bucket="day", start=None, end=None):
+    total_revenue, total_items = get_sales_totals(vendor_id, start, end)
+
+    # REVENUE OVER TIME
+    revenue_over_time = get_revenue_over_time(vendor_id, bucket, start, end)
+    ROT_data = [
+        go.Bar(
+            x=[period for period, _ in revenue_over_time],
+            y=[revenue for _, revenue in revenue_over_time],
+        )
+    ]
+
+    # REVENUE BY CATEGORY
+    revenue_by_category = get_revenue_by_category(vendor_id, start, end)
+    RBC_data = [
+        go.Bar(
+            x=[category for category, _ in revenue_by_category],
+            y=[revenue for _, revenue in revenue_by_category],
+        )
+    ]
+    return {
+        "revenue_over_time_plot": json.dumps(ROT_data, cls=PlotlyJSONEncoder),
+        "revenue_by_category_plot": json.dumps(RBC_data, cls=PlotlyJSONEncoder),
+        "total_revenue": total_revenue,
+        "total_items": total_items,
+    }
+
+
+def filter_sales(query, vendor_id, start=None, end=None):
+    query = query.filter(SalesRollup.vendor_id == vendor_id)
+    if start:
+        query = query.filter(SalesRollup.day >= start)
+    if end:
+        query = query.filter(SalesRollup.day < end)
+    return query
+
+
+def get_sales_totals(vendor_id, start=None, end=None):
+    query = db.session.query(
+        db.func.coalesce(db.func.sum(SalesRollup.revenue), 0),
+        db.func.coalesce(db.func.sum(SalesRollup.units), 0),
+    )
+    return filter_sales(query, vendor_id, start, end).one()
+
+
+def get_revenue_over_time(vendor_id, bucket="day", start=None, end=None):
+    period = db.func.strftime(BUCKET_FORMATS[bucket], SalesRollup.day)
+    query = (
+        db.session.query(period, db.func.sum(SalesRollup.revenue))
+        .group_by(period)
+        .order_by(period)
+    )
+    return filter_sales(query, vendor_id, start, end).all()
+
+
+def get_revenue_by_category(vendor_id, start=None, end=None):
+    query = db.session.query(
+        SalesRollup.category, db.func.sum(SalesRollup.revenue)
+    ).group_by(SalesRollup.category)
+    revenue = dict(filter_sales(query, vendor_id, start, end).all())
+    return [
+        (category, revenue.get(category, 0)) for category in AddItemForm.CATEGORIES
+    ]
+
+
+######## CHECKOUT ########
+
+# NOTE : an item is claimed with a conditional UPDATE, sqlite serialises the
+# writers so exactly one concurrent buyer sees a matched row. everyone else
+# gets ItemUnavailable before anything else is staged
+
+
+class ItemUnavailable(Exception):
+    pass
+
+
+def checkout_item(item_id, buyer_id):
+    # NOTE : stages the sale, the caller commits
+    claimed = Item.query.filter(
+        Item.id == item_id, Item.status == "available"
+    ).update({Item.status: "bought"}, synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
+        raise ItemUnavailable(item_id)
+    vendor_id, category, value = (
+        db.session.query(Item.user_id, Item.category, Item.base_price)
+        .filter(Item.id == item_id)
+        .one()
+    )
+    date_transacted = datetime.utcnow()
+    transaction = Transaction(
+        user_id=buyer_id,
+        item_id=item_id,
+        vendor_id=vendor_id,
+        value=value,
+        date_transacted=date_transacted,
+    )
+    db.session.add(transaction)
+    db.session.flush()
+    record_sale(vendor_id, value)
+    record_sale_rollup(vendor_id, category, value, date_transacted.date())
+    return transaction
+
+
+@app.errorhandler(ItemUnavailable)
+def item_unavailable(error):
+    return "Sorry, this item has already been sold.", 409
+
+
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_COLUMNS = (
+    "transaction_id",
+    "date_transacted",
+    "item_id",
+    "item_name",
+    "category",
+    "value",
+    "buyer_id",
+)
+
+
+def export_sales(vendor_id, export_format, start=None, end=None):
+    # NOTE : rows come off a streaming cursor EXPORT_BATCH_SIZE at a time and
+    # each batch is written out before the next is fetched, so memory stays
+    # flat however long the vendor's history is
+    batch_size = app.config["EXPORT_BATCH_SIZE"]
+    query = (
+        db.session.query(
+            Transaction.id,
+            Transaction.date_transacted,
+            Item.id,
+            Item.name,
+            Item.category,
+            Transaction.value,
+            Transaction.user_id,
+        )
+        .join(Item, Item.id == Transaction.item_id)
+        .filter(Transaction.vendor_id == vendor_id)
+    )
+    if start:
+        query = query.filter(
+            Transaction.date_transacted >= datetime.combine(start, datetime.min.time())
+        )
+    if end:
+        query = query.filter(
+            Transaction.date_transacted < datetime.combine(end, datetime.min.time())
+        )
+    query = query.order_by(Transaction.id).yield_per(batch_size)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == "csv":
+        writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(query, 1):
+        values = (row[0], row[1].isoformat(), *row[2:])
+        if export_format == "csv":
+            writer.writerow(values)
+        else:
+            buffer.write(dumps_json(dict(zip(EXPORT_COLUMNS, values))).decode())
+            buffer.write("\n")
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+######## FEED ########
+
+# NOTE : listings are pushed into each follower's FeedEntry timeline when they
+# are posted, except for vendors above FEED_FANOUT_LIMIT followers whose items
+# are pulled in when the feed is read
+
+
+def trim_feeds(user_ids):
+    # drop everything past FEED_SIZE in the given users' timelines
+    positions = (
+        db.select(
+            FeedEntry.id,
+            db.func.row_number()
+            .over(
+                partition_by=FeedEntry.user_id,
+                order_by=(FeedEntry.date_posted.desc(), FeedEntry.id.desc()),
+            )
+            .label("position"),
+        )
+        .where(FeedEntry.user_id.in_(user_ids))
+        .subquery()
+    )
+    overflow = db.select(positions.c.id).where(
+        positions.c.position > app.config["FEED_SIZE"]
+    )
+    FeedEntry.query.filter(FeedEntry.id.in_(overflow)).delete(
+        synchronize_session=False
+    )
+
+
+def fan_out_item(item):
+    # NOTE : staged only, committed together with the item
+    db.session.flush()
+    vendor = item.author
+    if vendor.follower_count > app.config["FEED_FANOUT_LIMIT"]:
+        return
+    followers = db.select(UserFollow.user_id).where(
+        UserFollow.recipient_id == vendor.id
+    )
+    entries = db.select(
+        UserFollow.user_id,
+        db.literal(item.id),
+        db.literal(vendor.id),
+        db.literal(item.date_posted),
+    ).where(UserFollow.recipient_id == vendor.id)
+    db.session.execute(
+        db.insert(FeedEntry).from_select(
+            ["user_id", "item_id", "vendor_id", "date_posted"], entries
+        )
+    )
+    trim_feeds(followers)
+
+
+def backfill_feed(user, vendors):
+    # NOTE : give a new follower the vendors' recent listings, one INSERT for
+    # all of them
+    vendor_ids = [
+        vendor.id
+        for vendor in vendors
+        if vendor.follower_count <= app.config["FEED_FANOUT_LIMIT"]
+    ]
+    if not vendor_ids:
+        return
+    entries = (
+        db.select(db.literal(user.id), Item.id, Item.user_id, Item.date_posted)
+        .where(Item.user_id.in_(vendor_ids))
+        .order_by(Item.date_posted.desc())
+        .limit(app.config["FEED_SIZE"])
+    )
+    db.session.execute(
+        db.insert(FeedEntry).from_select(
+            ["user_id", "item_id", "vendor_id", "date_posted"], entries
+        )
+    )
+    trim_feeds([user.id])
+
+
+def feed_page(select, columns, cursor, page_size):
+    # NOTE : one branch of the feed, cut to a page in its own index order
+    if cursor:
+        values = db.tuple_(
+            *[db.literal(value, column.type) for column, value in zip(columns, cursor)]
+        )
+        select = select.where(db.tuple_(*columns) < values)
+    order = [column.desc() for column in columns]
+    return db.select(select.order_by(*order).limit(page_size + 1).subquery())
+
+
+def get_feed(user, cursor=None, page_size=None):
+    # NOTE : both branches walk their index from the cursor and stop after a
+    # page, so only two short pages are merged whatever the timeline length
+    page_size = page_size or app.config["PAGE_SIZE"]
+    pushed = (
+        db.select(
+            FeedEntry.item_id.label("item_id"),
+            FeedEntry.date_posted.label("date_posted"),
+        )
+        .join(Item, Item.id == FeedEntry.item_id)
+        .where(FeedEntry.user_id == user.id, Item.status == "available")
+    )
+    pulled = (
+        db.select(Item.id, Item.date_posted)
+        .join(UserFollow, UserFollow.recipient_id == Item.user_id)
+        .join(User, User.id == Item.user_id)
+        .where(
+            UserFollow.user_id == user.id,
+            User.follower_count > app.config["FEED_FANOUT_LIMIT"],
+            Item.status == "available",
+        )
+    )
+    # NOTE : union, an item pushed before its vendor crossed the fanout limit
+    # is pulled as well
+    feed = db.union(
+        feed_page(pushed, (FeedEntry.date_posted, FeedEntry.item_id), cursor, page_size),
+        feed_page(pulled, (Item.date_posted, Item.id), cursor, page_size),
+    ).subquery()
+    query = Item.query.join(feed, feed.c.item_id == Item.id)
+    return paginate(query, (feed.c.date_posted, feed.c.item_id), None, page_size)
+
+
+######## FEATURED ########
+
+# NOTE : score = (1 + recent likes) * (1 + vendor rating / 5), halved every
+# FEATURED_HALF_LIFE_DAYS since the item was posted
+
+
+def rank_featured_items():
+    now = datetime.utcnow()
+    like_window = now - timedelta(days=app.config["FEATURED_LIKE_WINDOW_DAYS"])
+    recent_likes = (
+        db.session.query(ItemLike.item_id, db.func.count(ItemLike.id).label("likes"))
+        .filter(ItemLike.date_liked >= like_window)
+        .group_by(ItemLike.item_id)
+        .subquery()
+    )
+    candidates = (
+        db.session.query(
+            Item.id,
+            Item.date_posted,
+            db.func.coalesce(recent_likes.c.likes, 0),
+            User.rating_sum,
+            User.review_count,
+        )
+        .join(User, User.id == Item.user_id)
+        .outerjoin(recent_likes, recent_likes.c.item_id == Item.id)
+        .filter(Item.status == "available")
+    )
+    half_life = app.config["FEATURED_HALF_LIFE_DAYS"]
+    scores = []
+    for item_id, date_posted, likes, rating_sum, review_count in candidates:
+        rating = rating_sum / review_count if review_count else 0
+        age = (now - date_posted).total_seconds() / 86400
+        score = (1 + likes) * (1 + rating / 5) * 0.5 ** (age / half_life)
+        scores.append({"item_id": item_id, "score": score})
+    scores.sort(key=lambda row: row["score"], reverse=True)
+
+    FeaturedItem.query.delete()
+    featured = scores[: app.config["FEATURED_SIZE"]]
+    if featured:
+        db.session.execute(db.insert(FeaturedItem), featured)
+    db.session.commit()
+
+
+def get_featured_items(limit=4):
+    items = (
+        Item.query.join(FeaturedItem, FeaturedItem.item_id == Item.id)
+        .filter(Item.status == "available")
+        .order_by(FeaturedItem.score.desc())
+        .limit(limit)
+        .all()
+    )
+    return items or get_fallback_items(limit)
+
+
+######## RECOMMENDATIONS ########
+
+# NOTE : item-item cosine similarity over the user x item interactions, where
+# a like counts LIKE_WEIGHT and a purchase PURCHASE_WEIGHT. the co-occurrence
+# is a self-join in sqlite, only pairs of items sharing a user ever exist and
+# python keeps the top RECOMMENDATION_NEIGHBOURS of each item
+
+LIKE_WEIGHT = 1.0
+PURCHASE_WEIGHT = 2.0
+
+
+def interaction_weights():
+    # one row per (user, item) with the summed weight of its likes and purchases
+    interactions = db.union_all(
+        db.select(
+            ItemLike.user_id.label("user_id"),
+            ItemLike.item_id.label("item_id"),
+            db.literal(LIKE_WEIGHT).label("weight"),
+        ),
+        db.select(
+            Transaction.user_id, Transaction.item_id, db.literal(PURCHASE_WEIGHT)
+        ),
+    ).subquery()
+    return (
+        db.select(
+            interactions.c.user_id,
+            interactions.c.item_id,
+            db.func.sum(interactions.c.weight).label("weight"),
+        )
+        .group_by(interactions.c.user_id, interactions.c.item_id)
+        .cte("weights")
+    )
+
+
+def rebuild_item_similarities(weights):
+    norms = {
+        item_id: math.sqrt(total)
+        for item_id, total in db.session.execute(
+            db.select(
+                weights.c.item_id, db.func.sum(weights.c.weight * weights.c.weight)
+            ).group_by(weights.c.item_id)
+        )
+    }
+    item, other = weights.alias("item"), weights.alias("other")
+    co_occurrence = (
+        db.select(
+            item.c.item_id,
+            other.c.item_id,
+            db.func.sum(item.c.weight * other.c.weight),
+        )
+        .join_from(
+            item,
+            other,
+            db.and_(
+                item.c.user_id == other.c.user_id, item.c.item_id != other.c.item_id
+            ),
+        )
+        .group_by(item.c.item_id, other.c.item_id)
+        .order_by(item.c.item_id)
+    )
+    similarities = []
+    for item_id, pairs in groupby(db.session.execute(co_occurrence), itemgetter(0)):
+        scores = (
+            (shared / (norms[item_id] * norms[other_id]), other_id)
+            for _, other_id, shared in pairs
+        )
+        similarities.extend(
+            {"item_id": item_id, "similar_item_id": other_id, "score": score}
+            for score, other_id in heapq.nlargest(
+                app.config["RECOMMENDATION_NEIGHBOURS"], scores
+            )
+        )
+    if similarities:
+        db.session.execute(db.insert(ItemSimilarity), similarities)
+
+
+def rebuild_user_recommendations(weights):
+    # NOTE : scores every user from the stored neighbours, the same way as
+    # update_user_recommendations, keeping the best RECOMMENDATION_SIZE each
+    seen = weights.alias("seen")
+    score = db.func.sum(ItemSimilarity.score * weights.c.weight)
+    scored = (
+        db.select(
+            weights.c.user_id,
+            ItemSimilarity.similar_item_id.label("item_id"),
+            score.label("score"),
+            db.func.row_number()
+            .over(partition_by=weights.c.user_id, order_by=score.desc())
+            .label("rank"),
+        )
+        .join_from(weights, ItemSimilarity, ItemSimilarity.item_id == weights.c.item_id)
+        .join(Item, Item.id == ItemSimilarity.similar_item_id)
+        .where(
+            Item.status == "available",
+            ~db.exists().where(
+                db.and_(
+                    seen.c.user_id == weights.c.user_id,
+                    seen.c.item_id == ItemSimilarity.similar_item_id,
+                )
+            ),
+        )
+        .group_by(weights.c.user_id, ItemSimilarity.similar_item_id)
+        .subquery()
+    )
+    db.session.execute(
+        db.insert(Recommendation).from_select(
+            ["user_id", "item_id", "score"],
+            db.select(scored.c.user_id, scored.c.item_id, scored.c.score).where(
+                scored.c.rank <= app.config["RECOMMENDATION_SIZE"]
+            ),
+        )
+    )
+
+
+def rebuild_recommendations():
+    ItemSimilarity.query.delete()
+    Recommendation.query.delete()
+    weights = interaction_weights()
+    rebuild_item_similarities(weights)
+    rebuild_user_recommendations(weights)
+    db.session.commit()
+
+
+def update_user_recommendations(user_id):
+    # NOTE : incremental path, rescores one user from the stored neighbours.
+    # only stages the rows, the caller commits
+    interactions = db.union_all(
+        db.select(
+            ItemLike.item_id.label("item_id"), db.literal(LIKE_WEIGHT).label("weight")
+        ).where(ItemLike.user_id == user_id),
+        db.select(
+            Transaction.item_id.label("item_id"),
+            db.literal(PURCHASE_WEIGHT).label("weight"),
+        ).where(Transaction.user_id == user_id),
+    ).subquery()
+    score = db.func.sum(ItemSimilarity.score * interactions.c.weight)
+    rows = (
+        db.session.query(ItemSimilarity.similar_item_id, score)
+        .join(interactions, interactions.c.item_id == ItemSimilarity.item_id)
+        .join(Item, Item.id == ItemSimilarity.similar_item_id)
+        .filter(
+            Item.status == "available",
+            ItemSimilarity.similar_item_id.notin_(db.select(interactions.c.item_id)),
+        )
+        .group_by(ItemSimilarity.similar_item_id)
+        .order_by(score.desc())
+        .limit(app.config["RECOMMENDATION_SIZE"])
+        .all()
+    )
+    Recommendation.query.filter_by(user_id=user_id).delete()
+    for item_id, item_score in rows:
+        recommendation = Recommendation(user_id=user_id, item_id=item_id, score=item_score)
+        db.session.add(recommendation)
+
+
+def fallback_items_query(limit):
+    return (
+        Item.query.filter_by(status="available")
+        .order_by(Item.date_posted.desc())
+        .limit(limit)
+    )
+
+
+def get_fallback_items(limit):
+    return fallback_items_query(limit).all()
+
+
+def get_recommended_items(user, limit=None):
+    limit = limit or app.config["RECOMMENDATION_SIZE"]
+    items = []
+    if user.is_authenticated:
+        items = (
+            Item.query.join(Recommendation, Recommendation.item_id == Item.id)
+            .filter(Recommendation.user_id == user.id, Item.status == "available")
+            .order_by(Recommendation.score.desc())
+            .limit(limit)
+            .all()
+        )
+    return items or get_fallback_items(limit)
+
+
+def similar_items_query(item_id, limit):
+    return (
+        Item.query.join(ItemSimilarity, ItemSimilarity.similar_item_id == Item.id)
+        .filter(ItemSimilarity.item_id == item_id, Item.status == "available")
+        .order_by(ItemSimilarity.score.desc())
+        .limit(limit)
+    )
+
+
+def get_similar_items(item, limit=None):
+    limit = limit or app.config["SIMILAR_ITEMS"]
+    return similar_items_query(item.id, limit).all() or get_fallback_items(limit)
+
+
+######## SEARCH ########
+
+
+class WhooshSearchBackend:
+    """flask_msearch backed search over the on-disk whoosh index."""
+
+    def search_items(self, query):
+        return Item.query.msearch(query, fields=["name", "description"]).all()
+
+    def search_users(self, query):
+        return User.query.msearch(query, fields=["username", "description"]).all()
+
+    def reindex(self):
+        search.create_index(update=True)
+
+
+class FTS5SearchBackend:
+    """SQLite FTS5 search kept in sync with the item/user tables by triggers."""
 
-    @property
-    def price(self):
-        return "{:.2f}".format(self.base_price)
+    # NOTE : table -> indexed columns, each gets a "<table>_fts" index
+    INDEXES = {"item": ["name", "description"], "user": ["username", "description"]}
 
-    def __repr__(self):
-        return f"Item(name='{self.name}',date_posted='{self.date_posted}',image_file='{self.image_file}')"
+    def install(self):
+        for table, columns in self.INDEXES.items():
+            fts = f"{table}_fts"
+            names = ", ".join(columns)
+            new_values = ", ".join(f"new.{column}" for column in columns)
+            old_values = ", ".join(f"old.{column}" for column in columns)
+            insert = f"INSERT INTO {fts}(rowid, {names}) VALUES (new.id, {new_values});"
+            delete = (
+                f"INSERT INTO {fts}({fts}, rowid, {names}) "
+                f"VALUES ('delete', old.id, {old_values});"
+            )
+            statements = [
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5"
+                f"({names}, content='{table}', content_rowid='id')",
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} "
+                f"BEGIN {insert} END",
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} "
+                f"BEGIN {delete} END",
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {names} "
+                f"ON {table} BEGIN {delete} {insert} END",
+            ]
+            for statement in statements:
+                db.session.execute(db.text(statement))
+        db.session.commit()
 
+    def reindex(self):
+        self.install()
+        for table in self.INDEXES:
+            fts = f"{table}_fts"
+            db.session.execute(db.text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+        db.session.commit()
 
-class Review(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    transaction_id = db.Column(
-        db.Integer, db.ForeignKey("transaction.id"), nullable=False
-    )
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    rating = db.Column(db.Integer, nullable=False)
-    comment = db.Column(db.String(500), nullable=False)
+    def match_expression(self, query):
+        # NOTE : quote every word so user input can't inject fts5 syntax
+        words = re.findall(r"\w+", query or "")
+        return " ".join(f'"{word}"*' for word in words)
+
+    def ranked(self, model, query):
+        fts = f"{model.__tablename__}_fts"
+        ranked = (
+            db.text(
+                f"SELECT rowid AS id, bm25({fts}) AS rank FROM {fts} "
+                f"WHERE {fts} MATCH :query"
+            )
+            .bindparams(query=self.match_expression(query))
+            .columns(id=db.Integer, rank=db.Float)
+            .subquery()
+        )
+        return model.query.join(ranked, ranked.c.id == model.id).order_by(
+            ranked.c.rank
+        )
 
-    def __repr__(self):
-        return f"Review(user_id={self.user_id},recipient_id={self.recipient_id},rating={self.rating},comment='{self.comment}')"
+    def search_items(self, query):
+        if not self.match_expression(query):
+            return []
+        return self.ranked(Item, query).all()
 
+    def search_users(self, query):
+        if not self.match_expression(query):
+            return []
+        return self.ranked(User, query).all()
 
-class ItemLike(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    item_id = db.Column(db.Integer, db.ForeignKey("item.id"), nullable=False)
 
-    def __repr__(self):
-        return f"ItemLike(user_id={self.user_id},item_id={self.item_id})"
+SEARCH_BACKENDS = {"whoosh": WhooshSearchBackend, "fts5": FTS5SearchBackend}
+search_backend = SEARCH_BACKENDS[app.config["SEARCH_BACKEND"]]()
 
+# NOTE : token -> {"search", "item_ids", "categories"}, so refining a search
+# never has to put the matching ids in the url
+search_results = LRUCache(
+    app.config["SEARCH_RESULTS_SIZE"], ttl=app.config["SEARCH_RESULTS_TTL"]
+)
 
-class UserFollow(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 
-    def __repr__(self):
-        return f"UserFollow(user_id={self.user_id},recipient_id={self.recipient_id})"
+def store_search_results(search, items, users):
+    # NOTE : ids are kept per category in rank order, so a page of any
+    # category is a slice of one list plus one query
+    item_ids = {"All": [item.id for item in items]}
+    for item in items:
+        item_ids.setdefault(item.category, []).append(item.id)
+    token = uuid4().hex[:12]
+    results = {
+        "search": search,
+        "item_ids": item_ids,
+        "user_ids": [user.id for user in users],
+    }
+    search_results.set(token, results)
+    return token, results
 
 
-class Transaction(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    item_id = db.Column(db.Integer, db.ForeignKey("item.id"), nullable=False)
-    vendor_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    value = db.Column(db.Float, nullable=False)
-    date_transacted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+def get_search_results_page(results, category, start=0, page_size=None):
+    page_size = page_size or app.config["PAGE_SIZE"]
+    item_ids = results["item_ids"].get(category, [])
+    page_ids = item_ids[start : start + page_size]
+    rank = {item_id: index for index, item_id in enumerate(page_ids)}
+    items = Item.query.filter(Item.id.in_(page_ids)).all() if page_ids else []
+    next_start = start + page_size if start + page_size < len(item_ids) else None
+    return sorted(items, key=lambda item: rank[item.id]), next_start
 
-    def __repr__(self):
-        return f"Transaction(user_id={self.user_id},vendor_id={self.vendor_id},item_id={self.item_id},value={self.value},date_transacted='{self.date_transacted}')"
 
+def get_search_users_page(results, page_size=None):
+    page_size = page_size or app.config["PAGE_SIZE"]
+    page_ids = results["user_ids"][:page_size]
+    rank = {user_id: index for index, user_id in enumerate(page_ids)}
+    users = User.query.filter(User.id.in_(page_ids)).all() if page_ids else []
+    return sorted(users, key=lambda user: rank[user.id])
 
-class PasswordPin(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    pin = db.Column(db.Integer, nullable=False)
+
+def count_search_results(results):
+    return {
+        category: len(item_ids) for category, item_ids in results["item_ids"].items()
+    }
 
 
 ######## FORMS ########
@@ -254,20 +1934,11 @@ class LoginForm(FlaskForm):
     password = PasswordField("Password", validators=[DataRequired(), Length(8, 150)])
     remember = BooleanField("Remember me")
     submit = SubmitField("Login")
-    
-    
-
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user and (user.password != self.password.data):
-            raise ValidationError("Wrong Username or Password. Please check again.")
 
     def validate_password(self, password):
-       user = User.query.filter_by(username=self.username.data).first()
-       if user and (user.password != password.data):
-           raise ValidationError("Wrong Username or Password. Please check again.") 
-    #####password2 = pbkdf2_sha256.hash("Password")
-
+        user = User.query.filter_by(username=self.username.data).first()
+        if not user or not verify_password(password.data, user.password):
+            raise ValidationError("Wrong Username or Password. Please check again.")
 
 
 class RegisterForm(FlaskForm):
@@ -402,6 +2073,516 @@ class ResetPasswordForm(FlaskForm):
     submit = SubmitField("Reset")
 
 
+######## IMAGES ########
+
+# NOTE : uploads are encoded on image_pool so the request returns straight
+# away, templates fall back to the original file until the variants exist
+
+image_pool = ThreadPoolExecutor(
+    max_workers=app.config["IMAGE_WORKERS"], thread_name_prefix="image"
+)
+IMAGE_FORMATS = {"webp": ("WEBP", {"quality": 80}), "jpg": ("JPEG", {"quality": 85})}
+
+
+def log_image_failure(future):
+    if future.exception() is not None:
+        app.logger.error("image job failed", exc_info=future.exception())
+
+
+def submit_image_job(job, *args):
+    future = image_pool.submit(job, *args)
+    future.add_done_callback(log_image_failure)
+    return future
+
+
+def save_atomically(image, path, image_format, **options):
+    # NOTE : write then rename so a half written variant is never served
+    temporary = f"{path}.tmp"
+    image.save(temporary, image_format, **options)
+    os.replace(temporary, path)
+
+
+def variant_path(path, width, extension):
+    stem, _ = os.path.splitext(path)
+    return f"{stem}_{width}.{extension}"
+
+
+def make_image_variants(path):
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    # NOTE : the widest jpg is written last, image_variants checks for it
+    for width in sorted(app.config["IMAGE_WIDTHS"]):
+        variant = image
+        if image.width > width:
+            height = round(image.height * width / image.width)
+            variant = image.resize((width, height), Image.LANCZOS)
+        for extension, (image_format, options) in IMAGE_FORMATS.items():
+            save_atomically(
+                variant, variant_path(path, width, extension), image_format, **options
+            )
+
+
+def encode_item_image(filename):
+    make_image_variants(f"./static/img/fish/{filename}")
+    with app.app_context():
+        touch_image_rows("fish", filename)
+
+
+PROFILE_PICTURE_SIZE = 250
+
+
+def profile_picture_name(filename):
+    # NOTE : the cropped derivative of an upload, immutable like the upload
+    stem, extension = os.path.splitext(filename)
+    return f"{stem}_{PROFILE_PICTURE_SIZE}{extension}"
+
+
+def crop_profile_picture(filename, user_id):
+    im = Image.open(f"./static/img/profile/{filename}")
+    image_format = im.format
+    width, height = im.size
+    new_width = PROFILE_PICTURE_SIZE
+    new_height = PROFILE_PICTURE_SIZE
+    left = (width - new_width) / 2
+    top = (height - new_height) / 2
+    right = (width + new_width) / 2
+    bottom = (height + new_height) / 2
+    im = im.crop((left, top, right, bottom))
+    cropped = profile_picture_name(filename)
+    save_atomically(im, f"./static/img/profile/{cropped}", image_format)
+    with app.app_context():
+        # NOTE : only if the user hasn't picked another picture in the meantime
+        User.query.filter_by(id=user_id, image_file=filename).update(
+            {User.image_file: cropped}, synchronize_session=False
+        )
+        stage_fragment_changes([("user", user_id)])
+        db.session.commit()
+    user_cache.delete(user_id)
+
+
+# NOTE : uploads are stored under the sha256 of their content, so identical
+# uploads share one file and a name never changes content once processed
+IMAGE_FOLDERS = {"fish": lambda: Item.image_file, "profile": lambda: User.image_file}
+HASHED_IMAGE = re.compile(r"^img/(fish|profile)/([0-9a-f]{64})(_\d+)?\.\w+$")
+
+
+def store_image(upload, folder):
+    # returns (filename, stored), stored is False when the content already exists
+    data = upload.read()
+    extension = os.path.splitext(secure_filename(upload.filename))[1].lower()
+    filename = f"{hashlib.sha256(data).hexdigest()}{extension}"
+    path = f"./static/img/{folder}/{filename}"
+    if os.path.exists(path):
+        return filename, False
+    temporary = f"{path}.{uuid4().hex}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+    return filename, True
+
+
+def touch_image_rows(folder, filename):
+    # NOTE : finished variants change how rows render without a commit of their
+    # own, bump date_modified so cached fragments and validators move on
+    column = IMAGE_FOLDERS[folder]()
+    for row in column.class_.query.filter(column == filename):
+        row.date_modified = datetime.utcnow()
+    db.session.commit()
+
+
+def count_image_references(folder):
+    column = IMAGE_FOLDERS[folder]()
+    return dict(db.session.query(column, db.func.count()).group_by(column).all())
+
+
+def collect_orphan_images(folder):
+    # hashed files (and their variants) no Item/User row points at any more.
+    # a row may point at the upload or at one of its derivatives
+    referenced = set()
+    for filename, count in count_image_references(folder).items():
+        match = HASHED_IMAGE.match(f"img/{folder}/{filename}")
+        if match and count:
+            referenced.add(match.group(2))
+    orphans = []
+    for name in sorted(os.listdir(f"./static/img/{folder}")):
+        match = HASHED_IMAGE.match(f"img/{folder}/{name}")
+        if match and match.group(2) not in referenced:
+            orphans.append(f"./static/img/{folder}/{name}")
+    return orphans
+
+
+@app.after_request
+def cache_hashed_images(response):
+    # NOTE : hashed names are immutable, let browsers keep them for a year
+    if request.endpoint == "static" and response.status_code in (200, 304):
+        if HASHED_IMAGE.match(request.view_args.get("filename", "")):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config["IMAGE_MAX_AGE"]
+            response.cache_control.immutable = True
+    return response
+
+
+@app.template_global()
+def image_variants(folder, filename):
+    # returns srcset strings for every format, or None while still encoding
+    path = os.path.join(app.static_folder, folder, filename)
+    widths = sorted(app.config["IMAGE_WIDTHS"])
+    if not os.path.exists(variant_path(path, widths[-1], "jpg")):
+        return None
+    variants = {}
+    for extension in IMAGE_FORMATS:
+        variants[extension] = ", ".join(
+            url_for("static", filename=variant_path(folder + filename, width, extension))
+            + f" {width}w"
+            for width in widths
+        )
+    variants["src"] = url_for(
+        "static", filename=variant_path(folder + filename, widths[0], "jpg")
+    )
+    return variants
+
+
+######## STATIC ASSETS ########
+
+# NOTE : flask build-assets writes static/manifest.json mapping every asset to
+# a fingerprinted name and its sha256, plus .gz/.br copies of text assets.
+# url_for("static") hands out the fingerprinted name and send_static_asset
+# maps it back, so nothing is hashed per request
+
+ASSET_MANIFEST = os.path.join(app.static_folder, "manifest.json")
+COMPRESSIBLE_ASSETS = (".css", ".js", ".svg")
+ASSET_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def build_assets():
+    manifest = {}
+    for root, _, names in os.walk(app.static_folder):
+        for name in names:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, "/")
+            if (
+                filename == "manifest.json"
+                or filename.endswith((".gz", ".br", ".tmp"))
+                or HASHED_IMAGE.match(filename)
+            ):
+                continue
+            with open(path, "rb") as file:
+                data = file.read()
+            digest = hashlib.sha256(data).hexdigest()
+            stem, extension = os.path.splitext(filename)
+            manifest[filename] = {
+                "path": f"{stem}.{digest[:12]}{extension}",
+                "etag": digest,
+            }
+            if extension in COMPRESSIBLE_ASSETS:
+                with open(f"{path}.gz", "wb") as file:
+                    file.write(gzip.compress(data, compresslevel=9))
+                if brotli is not None:
+                    with open(f"{path}.br", "wb") as file:
+                        file.write(brotli.compress(data))
+    with open(ASSET_MANIFEST, "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_asset_manifest():
+    if not os.path.exists(ASSET_MANIFEST):
+        return {}
+    with open(ASSET_MANIFEST) as file:
+        return json.load(file)
+
+
+asset_manifest = load_asset_manifest()
+fingerprinted_assets = {
+    entry["path"]: (filename, entry) for filename, entry in asset_manifest.items()
+}
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == "static":
+        entry = asset_manifest.get(values.get("filename"))
+        if entry:
+            values["filename"] = entry["path"]
+
+
+def send_static_asset(filename):
+    asset = fingerprinted_assets.get(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+    filename, entry = asset
+    path = os.path.join(app.static_folder, filename)
+    etag = entry["etag"]
+    encoding = None
+    for candidate, suffix in ASSET_ENCODINGS:
+        if request.accept_encodings[candidate] and os.path.exists(path + suffix):
+            encoding = candidate
+            path += suffix
+            etag = f"{etag}-{candidate}"
+            break
+    response = send_file(
+        path,
+        mimetype=mimetypes.guess_type(filename)[0],
+        download_name=os.path.basename(filename),
+        etag=etag,
+        conditional=True,
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["ASSET_MAX_AGE"]
+    response.cache_control.immutable = True
+    return response
+
+
+app.view_functions["static"] = send_static_asset
+
+
+######## MAIL ########
+
+# NOTE : requests only enqueue OutboxMail rows, send_outbox delivers them in
+# batches over one SMTP connection and backs off exponentially on failure
+
+
+def enqueue_mail(subject, recipients, body):
+    # staged only, committed together with whatever triggered the mail
+    outbox_mail = OutboxMail(
+        subject=subject,
+        sender=app.config.get("MAIL_USERNAME"),
+        recipients=",".join(recipients),
+        body=body,
+    )
+    db.session.add(outbox_mail)
+    return outbox_mail
+
+
+def claim_outbox(now):
+    # NOTE : lease a batch with one UPDATE so two senders never share a row
+    claim = uuid4().hex
+    due = (
+        db.select(OutboxMail.id)
+        .where(
+            OutboxMail.sent_at.is_(None),
+            OutboxMail.attempts < app.config["MAIL_MAX_ATTEMPTS"],
+            OutboxMail.next_attempt <= now,
+        )
+        .order_by(OutboxMail.id)
+        .limit(app.config["MAIL_BATCH_SIZE"])
+    )
+    lease = now + timedelta(seconds=app.config["MAIL_RETRY_DELAY"])
+    OutboxMail.query.filter(OutboxMail.id.in_(due)).update(
+        {OutboxMail.claim: claim, OutboxMail.next_attempt: lease},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return OutboxMail.query.filter_by(claim=claim).order_by(OutboxMail.id).all()
+
+
+def mark_mail_failed(outbox_mail, error):
+    outbox_mail.attempts += 1
+    delay = app.config["MAIL_RETRY_DELAY"] * 2 ** (outbox_mail.attempts - 1)
+    outbox_mail.next_attempt = datetime.utcnow() + timedelta(seconds=delay)
+    outbox_mail.last_error = str(error)[:500]
+    app.logger.warning(f"sending outbox mail {outbox_mail.id} failed: {error}")
+
+
+def send_outbox():
+    batch = claim_outbox(datetime.utcnow())
+    if not batch:
+        return 0
+    sent = 0
+    failed = set()
+    try:
+        with mail.connect() as connection:
+            for outbox_mail in batch:
+                try:
+                    connection.send(outbox_mail.to_message())
+                except Exception as error:
+                    mark_mail_failed(outbox_mail, error)
+                    failed.add(outbox_mail.id)
+                    continue
+                outbox_mail.sent_at = datetime.utcnow()
+                sent += 1
+    except Exception as error:
+        # NOTE : the connection itself failed, retry everything not yet sent
+        for outbox_mail in batch:
+            if outbox_mail.sent_at is None and outbox_mail.id not in failed:
+                mark_mail_failed(outbox_mail, error)
+    for outbox_mail in batch:
+        outbox_mail.claim = None
+    db.session.commit()
+    return sent
+
+
+######## BACKGROUND JOBS ########
+
+
+class PeriodicJob(Thread):
+    """Daemon thread running job inside an app context every interval seconds."""
+
+    def __init__(self, job, interval):
+        super().__init__(name=job.__name__, daemon=True)
+        self.job = job
+        self.interval = interval
+
+    def run(self):
+        while True:
+            with app.app_context():
+                try:
+                    self.job()
+                except Exception:
+                    app.logger.exception(f"{self.name} failed")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            time.sleep(self.interval)
+
+
+@app.before_first_request
+def start_background_jobs():
+    if app.config["FEATURED_RANK_INTERVAL"]:
+        PeriodicJob(rank_featured_items, app.config["FEATURED_RANK_INTERVAL"]).start()
+    if app.config["MAIL_OUTBOX_INTERVAL"]:
+        PeriodicJob(send_outbox, app.config["MAIL_OUTBOX_INTERVAL"]).start()
+
+
+######## CONDITIONAL REQUESTS ########
+
+# NOTE : item and profile pages are validated by a single query of indexed
+# scalar subqueries over everything the page shows. a matching If-None-Match
+# or If-Modified-Since is answered with a 304 before the page is loaded or
+# rendered. deletes (unlikes, unfollows) only move row counts and ids, so the
+# etag covers them while Last-Modified follows the row timestamps
+
+ITEM_MODIFIED = db.func.coalesce(Item.date_modified, Item.date_posted)
+USER_MODIFIED = db.func.coalesce(User.date_modified, User.date_joined)
+
+
+def latest(column, *criteria):
+    return db.select(db.func.max(column)).where(*criteria).scalar_subquery()
+
+
+def row_stamp(column, *criteria):
+    return (
+        db.select(db.func.count(column)).where(*criteria).scalar_subquery(),
+        latest(column, *criteria),
+    )
+
+
+def viewer_state():
+    # NOTE : like and follow buttons, plus the navbar, depend on the viewer
+    if not current_user.is_authenticated:
+        return ()
+    return (
+        latest(USER_MODIFIED, User.id == current_user.id),
+        *row_stamp(ItemLike.id, ItemLike.user_id == current_user.id),
+        *row_stamp(UserFollow.id, UserFollow.user_id == current_user.id),
+    )
+
+
+def rendered_items(query):
+    # NOTE : the ids a listing shows, in order, and the newest change among them
+    rows = query.with_entities(
+        Item.id, Item.date_posted, ITEM_MODIFIED.label("modified")
+    ).subquery()
+    return (
+        db.select(db.func.group_concat(rows.c.id)).scalar_subquery(),
+        db.select(db.func.max(rows.c.modified)).scalar_subquery(),
+        db.select(db.func.min(rows.c.date_posted)).scalar_subquery(),
+    )
+
+
+def item_page_state(item_id):
+    vendor_id = db.select(Item.user_id).where(Item.id == item_id).scalar_subquery()
+    similar_item_ids = db.select(ItemSimilarity.similar_item_id).where(
+        ItemSimilarity.item_id == item_id
+    )
+    review_author_ids = db.select(Review.user_id).where(
+        Review.recipient_id == vendor_id
+    )
+    limit = app.config["SIMILAR_ITEMS"]
+    # NOTE : the page shows the similar items, or the fallback when there are
+    # none, both sets go into the validator
+    similar_ids, _, _ = rendered_items(similar_items_query(item_id, limit))
+    fallback_ids, fallback_modified, oldest_fallback = rendered_items(
+        fallback_items_query(limit)
+    )
+    return (
+        latest(ITEM_MODIFIED, Item.id == item_id),
+        latest(USER_MODIFIED, User.id == vendor_id),
+        *row_stamp(Review.id, Review.recipient_id == vendor_id),
+        latest(USER_MODIFIED, User.id.in_(review_author_ids)),
+        *row_stamp(ItemSimilarity.id, ItemSimilarity.item_id == item_id),
+        # NOTE : sold similar items keep their row, their sale still moves this
+        latest(ITEM_MODIFIED, Item.id.in_(similar_item_ids)),
+        similar_ids,
+        fallback_ids,
+        fallback_modified,
+        # NOTE : an item sold out of the fallback drops from the ids above but
+        # was posted after the oldest fallback item now shown
+        latest(ITEM_MODIFIED, Item.date_posted >= oldest_fallback),
+        *viewer_state(),
+    )
+
+
+def profile_page_state(user_id):
+    review_author_ids = db.select(Review.user_id).where(Review.recipient_id == user_id)
+    follow_ids = db.union(
+        db.select(UserFollow.recipient_id).where(UserFollow.user_id == user_id),
+        db.select(UserFollow.user_id).where(UserFollow.recipient_id == user_id),
+    )
+    return (
+        latest(USER_MODIFIED, User.id == user_id),
+        *row_stamp(Item.id, Item.user_id == user_id),
+        latest(ITEM_MODIFIED, Item.user_id == user_id),
+        *row_stamp(Review.id, Review.recipient_id == user_id),
+        latest(USER_MODIFIED, User.id.in_(review_author_ids)),
+        *row_stamp(UserFollow.id, UserFollow.user_id == user_id),
+        *row_stamp(UserFollow.id, UserFollow.recipient_id == user_id),
+        latest(USER_MODIFIED, User.id.in_(follow_ids)),
+        *viewer_state(),
+    )
+
+
+def check_not_modified(*state_columns):
+    """Return a 304 when the client's copy of the page is still current."""
+    state = tuple(db.session.execute(db.select(*state_columns)).one())
+    if state[0] is None:
+        return None  # NOTE : missing row, leave the answer to the route
+    # NOTE : a cached page keeps the csrf token it was rendered with, so the
+    # etag rolls over well before that token expires
+    csrf_time_limit = app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    csrf_window = int(time.time() // (csrf_time_limit // 2)) if csrf_time_limit else 0
+    etag = hashlib.sha1(
+        repr((request.full_path, current_user.get_id(), csrf_window, state)).encode()
+    ).hexdigest()
+    stamps = [value for value in state if isinstance(value, datetime)]
+    last_modified = max(stamps) if stamps else None
+    g.page_validator = (etag, last_modified)
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    ):
+        return app.response_class(status=304)
+    return None
+
+
+@app.after_request
+def add_page_validators(response):
+    validator = g.pop("page_validator", None)
+    if validator is not None and response.status_code in (200, 304):
+        etag, last_modified = validator
+        response.set_etag(etag, weak=True)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add("Cookie")
+    return response
+
+
 ######## ROUTES ########
 
 
@@ -417,9 +2598,12 @@ def render_login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and (user.password == pbkdf2_sha256.verify(form.password.data)):
-            login_user(user, remember=form.remember.data)
-            return redirect("home")
+        if not is_password_hashed(user.password):
+            user.password = hash_password(form.password.data)
+            db.session.commit()
+            user_cache.delete(user.id)
+        login_user(user, remember=form.remember.data)
+        return redirect("home")
     return render_template("login.html", form=form)
 
 
@@ -431,7 +2615,7 @@ def render_register():
     if form.validate_on_submit():
         username = form.username.data
         email = form.email.data
-        password = pbkdf2_sha256.hash(form.password.data)
+        password = hash_password(form.password.data)
         user = User(username=username, email=email, password=password)
         db.session().add(user)
         db.session().commit()
@@ -450,15 +2634,8 @@ def render_forget():
         six_pin = str(int(np.random.randint(low=100000, high=999999, size=1)))
         real_pin = PasswordPin(user_id=user.id, pin=six_pin)
         db.session.add(real_pin)
+        enqueue_mail("Forget password", [str(email)], six_pin)
         db.session.commit()
-        with app.app_context():
-            msg = Message(
-                subject="Forget password",
-                sender=app.config.get("MAIL_USERNAME"),
-                recipients=[str(email)],
-                body=six_pin,
-            )
-            mail.send(msg)
         return redirect(url_for("render_pin", user_id=user.id))
     return render_template("forget.html", form=form)
 
@@ -466,18 +2643,17 @@ def render_forget():
 @app.route("/home")
 def render_home():
     search_form = SearchForm()
-    items = Item.query.filter_by(status="available").limit(4).all()
-    # NOTE : pretend r_items is a long list of reccomended items
-    r_items = items + items
-    f_items = items
+    r_items = get_recommended_items(current_user)
+    f_items = get_featured_items()
     l_items = []
+    feed_items = []
 
     if current_user.is_authenticated:
-        for like in current_user.liked:
-            item = Item.query.filter_by(id=like.item_id).first()
-            l_items.append(item)
+        l_items, _ = get_liked_items(current_user, page_size=4)
+        feed_items, _ = get_feed(current_user, page_size=8)
     return render_template(
         "home.html",
+        feed_items=feed_items,
         f_items=f_items,
         r_items=r_items,
         l_items=l_items,
@@ -487,16 +2663,19 @@ def render_home():
 
 @app.route("/item/<int:item_id>")
 def render_item(item_id):
-    r_items = Item.query.filter_by(status="available").limit(4).all()
+    not_modified = check_not_modified(*item_page_state(item_id))
+    if not_modified is not None:
+        return not_modified
     form = SearchForm()
-    item = Item.query.filter_by(id=item_id).first()
-    vendor = User.query.filter_by(id=item.user_id).first()
-    v_sold_count = len(vendor.sold)
-    reviews = vendor.reviewed[:4]
-    review_authors = [
-        User.query.filter_by(id=review.user_id).first() for review in reviews
-    ]
-    reviews = list(zip(review_authors, reviews))
+    item = (
+        Item.query.options(db.joinedload(Item.author))
+        .filter_by(id=item_id)
+        .first()
+    )
+    r_items = get_similar_items(item)
+    vendor = item.author
+    v_sold_count = vendor.sold_count
+    reviews, _ = get_reviews(vendor, page_size=4)
     if item:
         return render_template(
             "item.html",
@@ -509,14 +2688,38 @@ def render_item(item_id):
         )
 
 
+@app.route("/browse")
+def render_browse():
+    search_form = SearchForm()
+    category = request.args.get("category") or None
+    min_price = request.args.get("min_price", type=float)
+    max_price = request.args.get("max_price", type=float)
+    sort = request.args.get("sort", "newest")
+    if sort not in BROWSE_SORTS:
+        sort = "newest"
+    cursor = request.args.get("cursor", type=decode_cursor)
+    items, next_cursor = browse_items(category, min_price, max_price, sort, cursor)
+    facets = count_browse_facets(min_price, max_price)
+    return render_template(
+        "browse.html",
+        search_form=search_form,
+        items=items,
+        next_cursor=next_cursor,
+        facets=facets,
+        categories=AddItemForm.CATEGORIES,
+        category=category,
+        min_price=min_price,
+        max_price=max_price,
+        sort=sort,
+    )
+
+
 @app.route("/buy/<int:item_id>", methods=["GET", "POST"])
 @login_required
 def render_buy(item_id):
     search_form = SearchForm()
     form = PaymentForm()
     if form.validate_on_submit():
-        item = Item.query.filter_by(id=item_id).first()
-        vendor = User.query.filter_by(id=item.user_id).first()
         name = form.name.data
         card_number = form.card_number.data
         month = form.month.data
@@ -529,16 +2732,10 @@ def render_buy(item_id):
         ### --------------------------- ###
         ### --------------------------- ###
 
-        item.status = "bought"
-        transaction = Transaction(
-            user_id=current_user.id,
-            item_id=item.id,
-            vendor_id=vendor.id,
-            value=item.base_price,
-        )
-        db.session.add(transaction)
+        transaction = checkout_item(item_id, current_user.id)
+        update_user_recommendations(current_user.id)
         db.session.commit()
-        transaction = Transaction.query.filter_by(item_id=item.id).first()
+        figure_cache.invalidate(lambda key: key[0] == transaction.vendor_id)
         return redirect(url_for("render_review", transaction_id=transaction.id))
 
     return render_template("buy.html", search_form=search_form, form=form)
@@ -548,15 +2745,16 @@ def render_buy(item_id):
 @login_required
 def render_likes():
     search_form = SearchForm()
-    l_items = []
-    r_items = Item.query.filter_by(status="available").limit(4).all()
-    if current_user.is_authenticated:
-        for like in current_user.liked:
-            item = Item.query.filter_by(id=like.item_id).first()
-            l_items.append(item)
+    cursor = request.args.get("cursor", type=decode_cursor)
+    r_items = get_recommended_items(current_user, limit=4)
+    l_items, l_cursor = get_liked_items(current_user, cursor)
 
     return render_template(
-        "likes.html", search_form=search_form, l_items=l_items, r_items=r_items
+        "likes.html",
+        search_form=search_form,
+        l_items=l_items,
+        r_items=r_items,
+        l_cursor=l_cursor,
     )
 
 
@@ -564,23 +2762,24 @@ def render_likes():
 @login_required
 def render_my_items():
     search_form = SearchForm()
-    b_transactions = current_user.bought
-    b_items = [
-        Item.query.filter_by(id=transaction.item_id).first()
-        for transaction in b_transactions
-    ]
-    s_transactions = current_user.sold
-    s_items = [
-        Item.query.filter_by(id=transaction.item_id).first()
-        for transaction in s_transactions
-    ]
-    L_items = Item.query.filter_by(user_id=current_user.id, status="available").all()
+    b_items, b_cursor = get_bought_items(
+        current_user, request.args.get("bought", type=decode_cursor)
+    )
+    s_items, s_cursor = get_sold_items(
+        current_user, request.args.get("sold", type=decode_cursor)
+    )
+    L_items, L_cursor = get_listed_items(
+        current_user, request.args.get("listed", type=decode_cursor)
+    )
     return render_template(
         "my_item.html",
         search_form=search_form,
         b_items=b_items,
         s_items=s_items,
         L_items=L_items,
+        b_cursor=b_cursor,
+        s_cursor=s_cursor,
+        L_cursor=L_cursor,
     )
 
 
@@ -590,16 +2789,14 @@ def render_add_item():
     search_form = SearchForm()
     form = AddItemForm()
     if form.validate_on_submit():
-        image_file_name = form.image_file.data.filename
-        file_extentsion = image_file_name[-3:]
         name = form.name.data
         category = form.category.data
         description = form.description.data
         base_price = form.base_price.data
 
-        unique_file_name = uuid4()
-        filename = secure_filename(f"{unique_file_name}.{file_extentsion}")
-        form.image_file.data.save(f"./static/img/fish/{filename}")
+        filename, stored = store_image(form.image_file.data, "fish")
+        if stored:
+            submit_image_job(encode_item_image, filename)
         item = Item(
             user_id=current_user.id,
             name=name,
@@ -609,6 +2806,7 @@ def render_add_item():
             image_file=filename,
         )
         db.session.add(item)
+        fan_out_item(item)
         db.session.commit()
         return redirect(url_for("render_my_items"))
     return render_template("add_item.html", search_form=search_form, form=form)
@@ -616,56 +2814,57 @@ def render_add_item():
 
 @app.route("/profile/<int:user_id>", methods=["GET", "POST"])
 def render_profile(user_id):
+    if request.method in ("GET", "HEAD"):
+        not_modified = check_not_modified(*profile_page_state(user_id))
+        if not_modified is not None:
+            return not_modified
     user = User.query.filter_by(id=user_id).first()
     search_form = SearchForm()
     pfp_form = ProfilePictureForm()
     username_form = UsernameForm()
     description_form = DescriptionForm()
-    L_items = Item.query.filter_by(user_id=user.id, status="available").all()
-    len_of_L_items = len(L_items)
-    reviews = user.reviewed
-    review_authors = [
-        User.query.filter_by(id=review.user_id).first() for review in reviews
-    ]
-    reviews = list(zip(review_authors, reviews))
-    following = [User.query.filter_by(id=follow.recipient_id).first() for follow in user.following]
-    followers = [User.query.filter_by(id=follow.user_id).first() for follow in user.followers]
-    count_of_following = len(list(following))
-    count_of_followers = len(list(followers))
+    L_items, L_cursor = get_listed_items(
+        user, request.args.get("listed", type=decode_cursor)
+    )
+    len_of_L_items = Item.query.filter_by(user_id=user.id, status="available").count()
+    reviews, reviews_cursor = get_reviews(
+        user, request.args.get("reviews", type=decode_cursor)
+    )
+    following, following_cursor = get_following(
+        user, request.args.get("following", type=decode_cursor)
+    )
+    followers, followers_cursor = get_followers(
+        user, request.args.get("followers", type=decode_cursor)
+    )
+    count_of_following = UserFollow.query.filter_by(user_id=user.id).count()
+    count_of_followers = UserFollow.query.filter_by(recipient_id=user.id).count()
 
     if pfp_form.validate_on_submit():
         ### SAVE FILE ###
-        image_file_name = pfp_form.image_file.data.filename
-        file_extention = image_file_name[-3:]
-        unique_file_name = uuid4()
-        filename = secure_filename(f"{unique_file_name}.{file_extention}")
-        pfp_form.image_file.data.save(f"./static/img/profile/{filename}")
-
-        ### CROP IMAGE ###
-        im = Image.open(f"./static/img/profile/{filename}")
-        width, height = im.size
-        new_width = 250
-        new_height = 250
-        left = (width - new_width) / 2
-        top = (height - new_height) / 2
-        right = (width + new_width) / 2
-        bottom = (height + new_height) / 2
-        im = im.crop((left, top, right, bottom))
-        im.save(f"./static/img/profile/{filename}")
+        filename, _ = store_image(pfp_form.image_file.data, "profile")
+        cropped = profile_picture_name(filename)
+        cropped_exists = os.path.exists(f"./static/img/profile/{cropped}")
 
         ### CHANGE USER IMAGE FILE NAME ###
-        current_user.image_file = filename
+        current_user.image_file = cropped if cropped_exists else filename
         db.session.commit()
+        user_cache.delete(current_user.id)
+
+        ### CROP IMAGE ###
+        if not cropped_exists:
+            submit_image_job(crop_profile_picture, filename, current_user.id)
         return redirect(url_for("render_profile", user_id=current_user.id))
 
     if username_form.validate_on_submit():
         current_user.username = username_form.username.data
         db.session.commit()
+        user_cache.delete(current_user.id)
         return redirect(url_for("render_profile", user_id=current_user.id))
 
     if description_form.validate_on_submit():
         current_user.description = description_form.description.data
         db.session.commit()
+        user_cache.delete(current_user.id)
         return redirect(url_for("render_profile", user_id=current_user.id))
 
     return render_template(
@@ -681,7 +2880,11 @@ def render_profile(user_id):
         count_of_followers=count_of_followers,
         count_of_following=count_of_following,
         followers=followers,
-        following=following
+        following=following,
+        L_cursor=L_cursor,
+        reviews_cursor=reviews_cursor,
+        following_cursor=following_cursor,
+        followers_cursor=followers_cursor,
     )
 
 
@@ -703,6 +2906,7 @@ def render_review(transaction_id):
             transaction_id=transaction_id,
         )
         db.session.add(review)
+        record_review(recipient_id, int(rating))
         db.session.commit()
         return redirect(url_for("render_home"))
 
@@ -711,102 +2915,115 @@ def render_review(transaction_id):
 
 @app.route("/search")
 def render_search():
-    search_form = SearchForm()
     search = request.args.get("search")
-    items = Item.query.msearch(search, fields=["name", "description"])
-    users = User.query.msearch(search, fields=["username", "description"])
+    items = search_backend.search_items(search)
+    users = search_backend.search_users(search)
     users = [user for user in users if user != current_user]
-    count_of_items = len(list(items))
-    count_of_users = len(list(users))
-    item_ids = "-".join([str(item.id) for item in items])
-    return render_template(
-        "search.html",
-        users=users,
-        search_form=search_form,
-        items=items,
-        search=search,
-        count_of_items=count_of_items,
-        count_of_users=count_of_users,
-        item_ids=item_ids,
-    )
+    token, results = store_search_results(search, items, users)
+    return render_search_results(token, results, "All")
+
 
+@app.route("/search/<string:token>/<string:category>")
+def render_search_by_category(token, category):
+    results = search_results.get(token)
+    if results is None:
+        # NOTE : expired or evicted, run the search again
+        return redirect(url_for("render_search", search=request.args.get("search")))
+    return render_search_results(token, results, category)
 
-@app.route("/search/<string:search>/<string:item_ids>/<string:category>")
-def render_search_by_category(search, item_ids, category):
+
+def render_search_results(token, results, category):
     search_form = SearchForm()
-    item_ids = item_ids.split("-")
-    items = [Item.query.filter_by(id=int(item_id)).first() for item_id in item_ids]
-    item_ids = "-".join(item_ids)
-    if category != "All":
-        items = [item for item in items if item.category == category]
-    count_of_items = len(list(items))
+    start = request.args.get("start", 0, type=int)
+    items, next_start = get_search_results_page(results, category, start)
+    categories = count_search_results(results)
+    users = []
+    if category == "All":
+        users = get_search_users_page(results)
     return render_template(
         "search.html",
+        users=users,
         search_form=search_form,
         items=items,
-        search=search,
-        count_of_items=count_of_items,
-        item_ids=item_ids,
+        search=results["search"],
+        count_of_items=categories.get(category, 0),
+        count_of_users=len(results["user_ids"]),
+        token=token,
+        categories=categories,
+        category=category,
+        next_start=next_start,
     )
 
 
 @app.route("/analytics")
 def render_analytics():
     search_form = SearchForm()
-    # REVENUE OVER TIME
-    sold = current_user.sold
-    items_sold = [
-        Item.query.filter_by(id=transaction.item_id).first() for transaction in sold
-    ]
-    value_of_transactions = [transaction.value for transaction in sold]
-    total_revenue = sum(value_of_transactions)
-    total_items = len(value_of_transactions)
-    date_of_transactions = [transaction.date_transacted.date() for transaction in sold]
-
-    revenue_over_time_df = pd.DataFrame(
-        {"x": date_of_transactions, "y": value_of_transactions}
-    )
-    ROT_data = [go.Bar(x=revenue_over_time_df["x"], y=revenue_over_time_df["y"])]
-    revenue_over_time_plot = json.dumps(ROT_data, cls=PlotlyJSONEncoder)
-
-    CATEGORIES = ["Fish", "Food", "Tank", "Decoration", "Utilties"]
-    revenue_by_fish = sum(
-        [item.base_price for item in items_sold if item.category == "Fish"]
-    )
-    revenue_by_food = sum(
-        [item.base_price for item in items_sold if item.category == "Food"]
-    )
-    revenue_by_tank = sum(
-        [item.base_price for item in items_sold if item.category == "Tank"]
-    )
-    revenue_by_decoration = sum(
-        [item.base_price for item in items_sold if item.category == "Decoration"]
-    )
-    revenue_by_utilities = sum(
-        [item.base_price for item in items_sold if item.category == "Utilities"]
-    )
-    list_of_revenue_by_category = [
-        revenue_by_fish,
-        revenue_by_food,
-        revenue_by_tank,
-        revenue_by_decoration,
-        revenue_by_utilities,
-    ]
-    revenue_by_category_df = pd.DataFrame(
-        {"x": CATEGORIES, "y": list_of_revenue_by_category}
-    )
-    RBC_data = [go.Bar(x=revenue_by_category_df["x"], y=revenue_by_category_df["y"])]
-    revenue_by_category_plot = json.dumps(RBC_data, cls=PlotlyJSONEncoder)
+    bucket = request.args.get("bucket", "day")
+    if bucket not in BUCKET_FORMATS:
+        bucket = "day"
+    start = request.args.get("start", type=parse_date)
+    end = request.args.get("end", type=parse_date)
+    if end:
+        # NOTE : make the end date inclusive
+        end += timedelta(days=1)
+
+    key = (current_user.id, bucket, start, end)
+    figures = figure_cache.get(key)
+    if figures is None:
+        figures = build_analytics_figures(current_user.id, bucket, start, end)
+        figure_cache.set(key, figures)
     return render_template(
         "analytics.html",
         search_form=search_form,
-        revenue_over_time_plot=revenue_over_time_plot,
-        revenue_by_category_plot=revenue_by_category_plot,
-        total_revenue=total_revenue,
-        total_items=total_items,
+        bucket=bucket,
+        **figures,
     )
 
 
+@app.route("/analytics/export.<export_format>")
+@login_required
+def export_analytics(export_format):
+    if export_format not in EXPORT_FORMATS:
+        return "Unknown export format", 404
+    start = request.args.get("start", type=parse_date)
+    end = request.args.get("end", type=parse_date)
+    if end:
+        # NOTE : make the end date inclusive
+        end += timedelta(days=1)
+    chunks = export_sales(current_user.id, export_format, start, end)
+    response = app.response_class(
+        stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format]
+    )
+    response.headers["Content-Disposition"] = (
+        f'attachment; filename="sales.{export_format}"'
+    )
+    return response
+
+
+@app.route("/metrics/passwords")
+@login_required
+def render_password_metrics():
+    return jsonify(password_pool.stats())
+
+
+@app.route("/metrics/users")
+@login_required
+def render_user_cache_metrics():
+    return jsonify(user_cache.stats())
+
+
+@app.route("/metrics/fragments")
+@login_required
+def render_fragment_metrics():
+    return jsonify(fragment_cache.stats())
+
+
+@app.route("/analytics/cache")
+@login_required
+def render_analytics_cache():
+    return jsonify(figure_cache.stats())
+
+
 @app.route("/pin/<int:user_id>", methods=["GET", "POST"])
 def render_pin(user_id):
     pin_form = PinForm()
@@ -821,8 +3038,9 @@ def render_reset_password(user_id):
     if reset_password_form.validate_on_submit():
         new_password = reset_password_form.password.data
         user = User.query.filter_by(id=user_id).first()
-        user.password = new_password
+        user.password = hash_password(new_password)
         db.session.commit()
+        user_cache.delete(user.id)
         return redirect(url_for("render_login"))
     return render_template(
         "reset_password.html", reset_password_form=reset_password_form
@@ -842,9 +3060,11 @@ def like_action(item_id, action):
     item = Item.query.filter(Item.id == item_id).first()
     if action == "like":
         current_user.like_item(item)
+        update_user_recommendations(current_user.id)
         db.session.commit()
     if action == "unlike":
         current_user.unlike_item(item)
+        update_user_recommendations(current_user.id)
         db.session.commit()
     return redirect(request.referrer)
 
@@ -861,5 +3081,660 @@ def follow_action(recipient_id, action):
     return redirect(request.referrer)
 
 
+######## API ########
+
+# NOTE : versioned json api for mobile clients and internal tools. reads are
+# batched by id, writes apply many likes or follows in one transaction. the
+# bulk writes only accept application/json bodies, which a cross site form
+# can't send, so session cookies are safe to use without a csrf token
+
+API_PREFIX = "/api/v1"
+
+API_ITEM_FIELDS = {
+    "id": lambda item: item.id,
+    "name": lambda item: item.name,
+    "description": lambda item: item.description,
+    "category": lambda item: item.category,
+    "price": lambda item: item.base_price,
+    "status": lambda item: item.status,
+    "vendor_id": lambda item: item.user_id,
+    "date_posted": lambda item: item.date_posted.isoformat(),
+    "image_url": lambda item: url_for(
+        "static", filename="img/fish/" + item.image_file
+    ),
+    "liked": lambda item: current_user.is_authenticated
+    and current_user.has_liked_item(item),
+}
+
+API_USER_FIELDS = {
+    "id": lambda user: user.id,
+    "username": lambda user: user.username,
+    "description": lambda user: user.description,
+    "date_joined": lambda user: user.date_joined.isoformat(),
+    "image_url": lambda user: url_for(
+        "static", filename="img/profile/" + user.image_file
+    ),
+    "review_count": lambda user: user.review_count,
+    "rating": lambda user: user.rating_sum / user.review_count
+    if user.review_count
+    else None,
+    "sold_count": lambda user: user.sold_count,
+    "follower_count": lambda user: user.follower_count,
+    "followed": lambda user: current_user.is_authenticated
+    and current_user.has_followed_user(user),
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@app.errorhandler(ApiError)
+def api_error(error):
+    return api_response({"error": error.message}, error.status)
+
+
+def dumps_json(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def api_response(payload, status=200):
+    return app.response_class(
+        dumps_json(payload), status=status, mimetype="application/json"
+    )
+
+
+def parse_ids(values, name):
+    if isinstance(values, str):
+        values = [value for value in values.split(",") if value.strip()]
+    if not isinstance(values, list):
+        raise ApiError(f"{name} must be a list of ids")
+    try:
+        ids = list(dict.fromkeys(int(value) for value in values))
+    except (TypeError, ValueError):
+        raise ApiError(f"{name} must be a list of ids")
+    if len(ids) > app.config["API_MAX_IDS"]:
+        raise ApiError(f"at most {app.config['API_MAX_IDS']} {name} per request")
+    return ids
+
+
+def select_fields(fields):
+    requested = request.args.get("fields")
+    if not requested:
+        return fields
+    names = [name.strip() for name in requested.split(",") if name.strip()]
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        raise ApiError(f"unknown fields: {', '.join(unknown)}")
+    return {name: fields[name] for name in names}
+
+
+def serialize_batch(model, ids, fields):
+    rows = {row.id: row for row in model.query.filter(model.id.in_(ids))}
+    return {
+        "data": [
+            {name: field(rows[row_id]) for name, field in fields.items()}
+            for row_id in ids
+            if row_id in rows
+        ],
+        "missing": [row_id for row_id in ids if row_id not in rows],
+    }
+
+
+def json_body():
+    if not request.is_json:
+        raise ApiError("expected an application/json body", 415)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ApiError("expected a json object")
+    return body
+
+
+@app.route(f"{API_PREFIX}/items")
+def api_items():
+    ids = parse_ids(request.args.get("ids", ""), "ids")
+    return api_response(serialize_batch(Item, ids, select_fields(API_ITEM_FIELDS)))
+
+
+@app.route(f"{API_PREFIX}/users")
+def api_users():
+    ids = parse_ids(request.args.get("ids", ""), "ids")
+    return api_response(serialize_batch(User, ids, select_fields(API_USER_FIELDS)))
+
+
+@app.route(f"{API_PREFIX}/likes", methods=["POST"])
+@login_required
+def api_likes():
+    body = json_body()
+    like_ids = parse_ids(body.get("like", []), "like")
+    unlike_ids = parse_ids(body.get("unlike", []), "unlike")
+    if set(like_ids) & set(unlike_ids):
+        raise ApiError("an item can't be liked and unliked at once")
+    requested = like_ids + unlike_ids
+    existing = {
+        item_id
+        for (item_id,) in db.session.query(Item.id).filter(Item.id.in_(requested))
+    }
+    liked = current_user.like_items(i for i in like_ids if i in existing)
+    unliked = current_user.unlike_items(i for i in unlike_ids if i in existing)
+    if liked or unliked:
+        update_user_recommendations(current_user.id)
+    db.session.commit()
+    return api_response(
+        {
+            "liked": sorted(liked),
+            "unliked": sorted(unliked),
+            "missing": [i for i in requested if i not in existing],
+        }
+    )
+
+
+@app.route(f"{API_PREFIX}/follows", methods=["POST"])
+@login_required
+def api_follows():
+    body = json_body()
+    follow_ids = parse_ids(body.get("follow", []), "follow")
+    unfollow_ids = parse_ids(body.get("unfollow", []), "unfollow")
+    if set(follow_ids) & set(unfollow_ids):
+        raise ApiError("a user can't be followed and unfollowed at once")
+    if current_user.id in follow_ids:
+        raise ApiError("users can't follow themselves")
+    users = {
+        user.id: user
+        for user in User.query.filter(User.id.in_(follow_ids + unfollow_ids))
+    }
+    followed = current_user.follow_users(
+        [users[i] for i in follow_ids if i in users]
+    )
+    unfollowed = current_user.unfollow_users(
+        [users[i] for i in unfollow_ids if i in users]
+    )
+    db.session.commit()
+    return api_response(
+        {
+            "followed": [user.id for user in followed],
+            "unfollowed": [user.id for user in unfollowed],
+            "missing": [i for i in follow_ids + unfollow_ids if i not in users],
+        }
+    )
+
+
+######## COMMANDS ########
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """Migrate the schema in place and backfill derived counters and indexes."""
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+            if column.server_default is not None:
+                ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+            db.session.execute(db.text(ddl))
+            print(f"added {table.name}.{column.name}")
+    db.session.commit()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    plain = [user for user in User.query if not is_password_hashed(user.password)]
+    for user in plain:
+        user.password = hash_password(user.password)
+    db.session.commit()
+    print(f"hashed {len(plain)} plain text passwords")
+    # NOTE : backfill everything derived from existing rows, so an upgraded
+    # database serves correct counters, rollups and search straight away
+    search_backend.reindex()
+    rebuild_reputation()
+    rebuild_sales_rollups()
+    print(f"backfilled {User.query.count()} users and {SalesRollup.query.count()} rollups")
+
+
+@app.cli.command("rebuild-reputation")
+def rebuild_reputation_command():
+    """Recompute every user's review and sales counters."""
+    rebuild_reputation()
+    print(f"rebuilt reputation for {User.query.count()} users")
+
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute the daily sales rollups from every transaction."""
+    rebuild_sales_rollups()
+    print(f"rebuilt {SalesRollup.query.count()} sales rollups")
+
+
+@app.cli.command("reindex-search")
+def reindex_search_command():
+    """Rebuild the search index of the configured backend."""
+    search_backend.reindex()
+    print(f"reindexed {app.config['SEARCH_BACKEND']} search")
+
+
+@app.cli.command("bench-search")
+@click.argument("queries", nargs=-1)
+@click.option("--repeat", default=50, help="Runs per query and backend.")
+def bench_search_command(queries, repeat):
+    """Compare query latency of the whoosh and fts5 search backends."""
+    queries = queries or ("fish", "tank", "food", "guppy betta")
+    for name, backend_class in SEARCH_BACKENDS.items():
+        backend = backend_class()
+        # NOTE : the inactive backend's index is not kept up to date, rebuild
+        # both so they search the same rows
+        backend.reindex()
+        for query in queries:
+            started = time.perf_counter()
+            for _ in range(repeat):
+                results = backend.search_items(query) + backend.search_users(query)
+            elapsed = (time.perf_counter() - started) / repeat
+            print(
+                f"{name:>6} {query!r:<16} {elapsed * 1000:8.2f} ms "
+                f"{len(results)} results"
+            )
+
+
+@app.cli.command("rebuild-recommendations")
+def rebuild_recommendations_command():
+    """Recompute item similarities and every user's recommendations."""
+    rebuild_recommendations()
+    print(
+        f"stored {ItemSimilarity.query.count()} item similarities and "
+        f"{Recommendation.query.count()} recommendations"
+    )
+
+
+@app.cli.command("rank-featured")
+def rank_featured_command():
+    """Recompute the featured items snapshot once."""
+    rank_featured_items()
+    print(f"ranked {FeaturedItem.query.count()} featured items")
+
+
+@app.cli.command("make-image-variants")
+def make_image_variants_command():
+    """Create the resized webp/jpg variants of every item image."""
+    for item in Item.query.filter(Item.image_file != "default.jpg").all():
+        path = f"./static/img/fish/{item.image_file}"
+        if os.path.exists(path):
+            make_image_variants(path)
+            touch_image_rows("fish", item.image_file)
+            print(f"encoded {item.image_file}")
+
+
+@app.cli.command("gc-images")
+@click.option("--dry-run", is_flag=True, help="Only list the orphaned files.")
+def gc_images_command(dry_run):
+    """Delete stored images that no item or user references."""
+    for folder in IMAGE_FOLDERS:
+        for path in collect_orphan_images(folder):
+            if not dry_run:
+                os.remove(path)
+            print(f"{'would remove' if dry_run else 'removed'} {path}")
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Fingerprint static assets and prebuild their compressed variants."""
+    manifest = build_assets()
+    print(f"wrote {len(manifest)} assets to {ASSET_MANIFEST}")
+
+
+@app.cli.command("send-mail")
+def send_mail_command():
+    """Send one batch of due outbox mail."""
+    print(f"sent {send_outbox()} mails")
+
+
+@app.cli.command("bench-passwords")
+@click.option(
+    "--rounds", multiple=True, type=int, help="pbkdf2 rounds, may be repeated."
+)
+@click.option("--logins", default=200, help="Verifications per round count.")
+@click.option("--clients", default=16, help="Concurrent request threads.")
+def bench_passwords_command(rounds, logins, clients):
+    """Measure login verification throughput through the password pool."""
+    # NOTE : spawning the workers imports the app in each of them, keep that
+    # out of the first round's latencies
+    password_pool.warm_up()
+    for round_count in rounds or (29000, 100000, 300000):
+        password_hash, _ = timed_hash("correct horse battery", round_count)
+        latencies = []
+
+        def login(_):
+            started = time.perf_counter()
+            verify_password("correct horse battery", password_hash)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(login, range(logins)))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        print(
+            f"{round_count:>7} rounds {logins / elapsed:8.1f} logins/s "
+            f"p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms "
+            f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.1f} ms"
+        )
+
+
+def copy_database(path):
+    """Snapshot the live database to path for benchmarks that write."""
+    source = sqlite3.connect(db.engine.url.database)
+    target = sqlite3.connect(path)
+    source.backup(target)
+    source.close()
+    target.close()
+    return path
+
+
+@contextmanager
+def scratch_database():
+    """Point the app at a throwaway copy of the database while benchmarking."""
+    workdir = tempfile.mkdtemp()
+    database_uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    db.session.remove()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + copy_database(
+        os.path.join(workdir, "scratch.db")
+    )
+    try:
+        yield
+    finally:
+        db.session.remove()
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@app.cli.command("bench-db")
+@click.option("--readers", default=8, help="Concurrent reader threads.")
+@click.option("--writers", default=1, help="Concurrent writer threads.")
+@click.option("--seconds", default=5.0, help="Run time per configuration.")
+def bench_db_command(readers, writers, seconds):
+    """Compare concurrent read throughput before and after the storage tuning."""
+    # NOTE : "before" is sqlite's stock journal and pragmas on NullPool without
+    # the foreign key indexes, "after" is the configured engine. both run on
+    # throwaway copies of the database so the live file is never touched
+    stock_pragmas = {
+        "journal_mode": "delete",
+        "synchronous": "full",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "busy_timeout": 15000,
+    }
+    configurations = (
+        (
+            "before",
+            stock_pragmas,
+            {"poolclass": NullPool, "connect_args": {"check_same_thread": False}},
+            True,
+        ),
+        (
+            "after",
+            app.config["SQLITE_PRAGMAS"],
+            app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+            False,
+        ),
+    )
+    user_ids = [user_id for user_id, in db.session.query(User.id)]
+    item_ids = [item_id for item_id, in db.session.query(Item.id)]
+    if not user_ids or not item_ids:
+        print("the database needs users and items to benchmark")
+        return
+    page_size = app.config["PAGE_SIZE"]
+
+    def read_statements(user_id):
+        return (
+            db.select(Item)
+            .where(Item.user_id == user_id)
+            .order_by(Item.date_posted.desc())
+            .limit(page_size),
+            db.select(Item.id)
+            .join(ItemLike, ItemLike.item_id == Item.id)
+            .where(ItemLike.user_id == user_id),
+            db.select(Review)
+            .where(Review.recipient_id == user_id)
+            .order_by(Review.date_posted.desc())
+            .limit(4),
+            db.select(db.func.count(UserFollow.id)).where(
+                UserFollow.recipient_id == user_id
+            ),
+            db.select(Transaction).where(Transaction.vendor_id == user_id),
+        )
+
+    workdir = tempfile.mkdtemp()
+    pragmas = app.config["SQLITE_PRAGMAS"]
+    try:
+        for name, bench_pragmas, engine_options, drop_fk_indexes in configurations:
+            path = copy_database(os.path.join(workdir, f"{name}.db"))
+            if drop_fk_indexes:
+                target = sqlite3.connect(path)
+                for table in db.metadata.sorted_tables:
+                    for index in table.indexes:
+                        if all(column.foreign_keys for column in index.columns):
+                            target.execute(f'DROP INDEX IF EXISTS "{index.name}"')
+                target.commit()
+                target.close()
+
+            app.config["SQLITE_PRAGMAS"] = bench_pragmas
+            engine = create_engine(f"sqlite:///{path}", **engine_options)
+            deadline = time.monotonic() + seconds
+            counts = {"reads": 0, "writes": 0, "locked": 0}
+            counts_lock = Lock()
+
+            def reader(offset):
+                reads = locked = 0
+                while time.monotonic() < deadline:
+                    user_id = user_ids[(offset + reads) % len(user_ids)]
+                    try:
+                        with engine.connect() as connection:
+                            for statement in read_statements(user_id):
+                                connection.execute(statement).fetchall()
+                        reads += 1
+                    except OperationalError:
+                        locked += 1
+                with counts_lock:
+                    counts["reads"] += reads
+                    counts["locked"] += locked
+
+            def writer(offset):
+                writes = locked = 0
+                while time.monotonic() < deadline:
+                    user_id = user_ids[(offset + writes) % len(user_ids)]
+                    item_id = item_ids[(offset + writes) % len(item_ids)]
+                    try:
+                        with engine.begin() as connection:
+                            like_id = connection.execute(
+                                db.insert(ItemLike).values(
+                                    user_id=user_id, item_id=item_id
+                                )
+                            ).inserted_primary_key[0]
+                        with engine.begin() as connection:
+                            connection.execute(
+                                db.delete(ItemLike).where(ItemLike.id == like_id)
+                            )
+                        writes += 1
+                    except OperationalError:
+                        locked += 1
+                with counts_lock:
+                    counts["writes"] += writes
+                    counts["locked"] += locked
+
+            threads = [Thread(target=reader, args=(i,)) for i in range(readers)]
+            threads += [Thread(target=writer, args=(i,)) for i in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            engine.dispose()
+            print(
+                f"{name:>6} {counts['reads'] / seconds:9.1f} page reads/s "
+                f"{counts['writes'] / seconds:8.1f} writes/s "
+                f"{counts['locked']} lock timeouts"
+            )
+    finally:
+        app.config["SQLITE_PRAGMAS"] = pragmas
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@app.cli.command("bench-checkout")
+@click.option("--items", default=200, help="Items put up for sale.")
+@click.option("--buyers", default=16, help="Concurrent buyer threads.")
+def bench_checkout_command(items, buyers):
+    """Race buyers for the same items and check every item sells exactly once."""
+    # NOTE : runs against a throwaway copy, every buyer tries every item
+    with scratch_database():
+        users = [
+            User(
+                username=f"bench-{uuid4().hex[:12]}",
+                email=f"{uuid4().hex}@bench.invalid",
+                password="bench",
+            )
+            for _ in range(buyers + 1)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+        vendor, buyer_ids = users[0], [user.id for user in users[1:]]
+        listed = [
+            Item(
+                user_id=vendor.id,
+                name=f"bench item {index}",
+                description="checkout stress test",
+                category="Fish",
+                base_price=1 + index % 50,
+            )
+            for index in range(items)
+        ]
+        db.session.add_all(listed)
+        db.session.commit()
+        item_ids = [item.id for item in listed]
+        counts = {"won": 0, "lost": 0, "failed": 0}
+        counts_lock = Lock()
+
+        def buyer(buyer_id):
+            won = lost = failed = 0
+            order = np.random.default_rng(buyer_id).permutation(item_ids)
+            with app.app_context():
+                for item_id in order:
+                    try:
+                        checkout_item(int(item_id), buyer_id)
+                        db.session.commit()
+                        won += 1
+                    except ItemUnavailable:
+                        lost += 1
+                    except OperationalError:
+                        db.session.rollback()
+                        failed += 1
+                db.session.remove()
+            with counts_lock:
+                counts["won"] += won
+                counts["lost"] += lost
+                counts["failed"] += failed
+
+        threads = [Thread(target=buyer, args=(buyer_id,)) for buyer_id in buyer_ids]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        sales = dict(
+            db.session.query(Transaction.item_id, db.func.count(Transaction.id))
+            .filter(Transaction.item_id.in_(item_ids))
+            .group_by(Transaction.item_id)
+        )
+        oversold = sum(1 for item_id in item_ids if sales.get(item_id, 0) > 1)
+        unsold = sum(1 for item_id in item_ids if not sales.get(item_id))
+        attempts = counts["won"] + counts["lost"] + counts["failed"]
+        print(
+            f"{attempts} checkouts by {buyers} buyers in {elapsed:.2f}s "
+            f"({attempts / elapsed:.1f}/s): {counts['won']} won, "
+            f"{counts['lost']} rejected, {counts['failed']} lock timeouts"
+        )
+        print(f"{oversold} items sold more than once, {unsold} items unsold")
+        if oversold:
+            raise click.ClickException(f"{oversold} items were oversold")
+
+
+@app.cli.command("bench-export")
+@click.option(
+    "--rows", multiple=True, type=int, help="Transactions to export, may be repeated."
+)
+def bench_export_command(rows):
+    """Measure sales export throughput and peak memory for growing histories."""
+    # NOTE : peak memory is measured in a second pass since tracemalloc slows
+    # everything down
+    with scratch_database():
+        vendor, buyer = [
+            User(
+                username=f"bench-{uuid4().hex[:12]}",
+                email=f"{uuid4().hex}@bench.invalid",
+                password="bench",
+            )
+            for _ in range(2)
+        ]
+        db.session.add_all([vendor, buyer])
+        db.session.flush()
+        listed = [
+            Item(
+                user_id=vendor.id,
+                name=f"bench item {index}",
+                description="export benchmark",
+                category=AddItemForm.CATEGORIES[index % len(AddItemForm.CATEGORIES)],
+                base_price=1 + index,
+                status="bought",
+            )
+            for index in range(50)
+        ]
+        db.session.add_all(listed)
+        db.session.commit()
+
+        inserted = 0
+        for row_count in sorted(rows or (10000, 100000)):
+            while inserted < row_count:
+                batch = min(10000, row_count - inserted)
+                db.session.execute(
+                    db.insert(Transaction),
+                    [
+                        {
+                            "user_id": buyer.id,
+                            "item_id": listed[index % len(listed)].id,
+                            "vendor_id": vendor.id,
+                            "value": listed[index % len(listed)].base_price,
+                            "date_transacted": datetime.utcnow()
+                            - timedelta(minutes=index),
+                        }
+                        for index in range(inserted, inserted + batch)
+                    ],
+                )
+                inserted += batch
+            db.session.commit()
+
+            for export_format in EXPORT_FORMATS:
+                started = time.perf_counter()
+                size = sum(len(chunk) for chunk in export_sales(vendor.id, export_format))
+                elapsed = time.perf_counter() - started
+                tracemalloc.start()
+                for _ in export_sales(vendor.id, export_format):
+                    pass
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(
+                    f"{row_count:>8} rows {export_format:>6} "
+                    f"{row_count / elapsed:10.0f} rows/s "
+                    f"{size / 1024 / 1024:7.1f} MiB out "
+                    f"peak {peak / 1024:8.0f} KiB"
+                )
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,55 @@
+import os
+import sys
+from uuid import uuid4
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as shop  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Point the app at an empty throwaway database for one test."""
+    overrides = {
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+        "TESTING": True,
+        "FEATURED_RANK_INTERVAL": 0,
+        "MAIL_OUTBOX_INTERVAL": 0,
+    }
+    original = {key: shop.app.config[key] for key in overrides}
+    shop.app.config.update(overrides)
+    backend = shop.fragment_cache.backend
+    shop.fragment_cache.backend = shop.make_fragment_backend()
+    with shop.app.app_context():
+        shop.db.create_all()
+        shop.search_backend.install()
+    # NOTE : no app context is held open here, requests must get their own g
+    # and session just like in production
+    yield shop.db
+    with shop.app.app_context():
+        shop.db.engine.dispose()
+    clear_caches()
+    shop.app.config.update(original)
+    shop.fragment_cache.backend = backend
+
+
+def clear_caches():
+    """Forget everything the in-process caches remember between requests."""
+    everything = lambda key: True  # noqa: E731
+    shop.user_cache.invalidate(everything)
+    shop.figure_cache.invalidate(everything)
+    shop.search_results.invalidate(everything)
+    shop.fragment_cache.backend.fragments.invalidate(everything)
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
+
+
+def make_user():
+    name = uuid4().hex[:12]
+    return shop.User(username=name, email=f"{name}@test.invalid", password="x")
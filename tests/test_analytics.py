@@ -0,0 +1,34 @@
+import re
+
+from conftest import login, make_user, shop
+
+
+def analytics_links(database, query):
+    with shop.app.app_context():
+        vendor = make_user()
+        database.session.add(vendor)
+        database.session.commit()
+    client = shop.app.test_client()
+    login(client, vendor.id)
+    html = client.get(f"/analytics{query}").get_data(as_text=True)
+    # NOTE : only the links with a query string, the navbar links /analytics
+    return [
+        link.replace("&amp;", "&")
+        for link in re.findall(r'href="(/analytics[^"]*\?[^"]*)"', html)
+    ]
+
+
+def test_bucket_and_export_links_keep_the_date_range(database):
+    links = analytics_links(database, "?start=2026-01-01&end=2026-01-31")
+    assert len(links) == 5  # three buckets and two exports
+    for link in links:
+        assert "start=2026-01-01" in link and "end=2026-01-31" in link
+    assert {link for link in links if "bucket=" in link} == {
+        f"/analytics?start=2026-01-01&end=2026-01-31&bucket={bucket}"
+        for bucket in ("day", "week", "month")
+    }
+
+
+def test_links_without_a_date_range_have_no_empty_bounds(database):
+    for link in analytics_links(database, ""):
+        assert "start=" not in link and "end=" not in link
@@ -0,0 +1,67 @@
+from threading import Barrier, Thread
+
+from sqlalchemy.exc import OperationalError
+
+from conftest import make_user, shop
+
+BUYERS = 8
+ITEMS = 20
+
+
+def buy_everything(buyer_id, item_ids, start):
+    start.wait()
+    with shop.app.app_context():
+        for item_id in item_ids:
+            while True:
+                try:
+                    shop.checkout_item(item_id, buyer_id)
+                    shop.db.session.commit()
+                except shop.ItemUnavailable:
+                    pass
+                except OperationalError:
+                    # NOTE : lock timeouts are retried so every item gets sold
+                    shop.db.session.rollback()
+                    continue
+                break
+        shop.db.session.remove()
+
+
+def test_concurrent_checkout_sells_each_item_once(database):
+    with shop.app.app_context():
+        users = [make_user() for _ in range(BUYERS + 1)]
+        database.session.add_all(users)
+        database.session.flush()
+        items = [
+            shop.Item(
+                user_id=users[0].id,
+                name=f"fish {index}",
+                description="a fish",
+                category="Fish",
+                base_price=1 + index,
+            )
+            for index in range(ITEMS)
+        ]
+        database.session.add_all(items)
+        database.session.commit()
+        buyer_ids = [user.id for user in users[1:]]
+        item_ids = [item.id for item in items]
+
+    start = Barrier(BUYERS)
+    threads = [
+        Thread(target=buy_everything, args=(buyer_id, item_ids, start))
+        for buyer_id in buyer_ids
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with shop.app.app_context():
+        sales = dict(
+            database.session.query(
+                shop.Transaction.item_id, database.func.count(shop.Transaction.id)
+            ).group_by(shop.Transaction.item_id)
+        )
+        bought = shop.Item.query.filter_by(status="bought").count()
+    assert sales == {item_id: 1 for item_id in item_ids}
+    assert bought == ITEMS
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from conftest import make_user, shop
+
+LONG_AGO = datetime(2026, 1, 1)
+
+
+def make_item(vendor, hours):
+    posted = LONG_AGO + timedelta(hours=hours)
+    return shop.Item(
+        user_id=vendor.id,
+        name=f"fish {hours}",
+        description="a fish",
+        category="Fish",
+        base_price=1,
+        date_posted=posted,
+        date_modified=posted,
+    )
+
+
+def test_selling_a_fallback_item_changes_the_item_page(database):
+    with shop.app.app_context():
+        seller, vendor, buyer = users = [make_user() for _ in range(3)]
+        for user in users:
+            user.date_joined = user.date_modified = LONG_AGO
+        database.session.add_all(users)
+        database.session.flush()
+        item = make_item(seller, 0)
+        # NOTE : no similarities, the page falls back to the newest listings
+        others = [make_item(vendor, hours) for hours in range(1, 7)]
+        database.session.add_all([item, *others])
+        database.session.commit()
+        item_id, buyer_id = item.id, buyer.id
+        sold_id = others[-2].id  # shown, but not the newest
+
+    client = shop.app.test_client()
+    first = client.get(f"/item/{item_id}")
+    assert first.status_code == 200
+    assert f"/item/{sold_id}" in first.get_data(as_text=True)
+    etag, last_modified = first.headers["ETag"], first.headers["Last-Modified"]
+    assert (
+        client.get(f"/item/{item_id}", headers={"If-None-Match": etag}).status_code
+        == 304
+    )
+
+    with shop.app.app_context():
+        shop.checkout_item(sold_id, buyer_id)
+        database.session.commit()
+
+    for headers in ({"If-None-Match": etag}, {"If-Modified-Since": last_modified}):
+        response = client.get(f"/item/{item_id}", headers=headers)
+        assert response.status_code == 200
+        assert f"/item/{sold_id}" not in response.get_data(as_text=True)
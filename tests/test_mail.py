@@ -0,0 +1,107 @@
+import socket
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from conftest import shop
+
+
+class Inbox:
+    """aiosmtpd handler keeping every envelope it accepts."""
+
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return "250 OK"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp(database, monkeypatch):
+    inbox = Inbox()
+    controller = Controller(inbox, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    state = shop.app.extensions["mail"]
+    monkeypatch.setattr(state, "server", "127.0.0.1")
+    monkeypatch.setattr(state, "port", controller.port)
+    monkeypatch.setattr(state, "use_ssl", False)
+    monkeypatch.setattr(state, "use_tls", False)
+    monkeypatch.setattr(state, "username", None)
+    monkeypatch.setattr(state, "suppress", False)
+    yield inbox, controller.port
+    controller.stop()
+
+
+def enqueue(subject):
+    with shop.app.app_context():
+        outbox_mail = shop.enqueue_mail(subject, ["buyer@test.invalid"], "hello")
+        shop.db.session.commit()
+        return outbox_mail.id
+
+
+def send():
+    with shop.app.app_context():
+        return shop.send_outbox()
+
+
+def load(outbox_mail_id):
+    with shop.app.app_context():
+        outbox_mail = shop.db.session.get(shop.OutboxMail, outbox_mail_id)
+        shop.db.session.expunge(outbox_mail)
+        return outbox_mail
+
+
+def test_outbox_delivers_over_smtp(smtp):
+    inbox, _ = smtp
+    outbox_mail_id = enqueue("delivered")
+
+    assert send() == 1
+    assert [envelope.rcpt_tos for envelope in inbox.envelopes] == [
+        ["buyer@test.invalid"]
+    ]
+    assert b"Subject: delivered" in inbox.envelopes[0].content
+    outbox_mail = load(outbox_mail_id)
+    assert outbox_mail.sent_at is not None
+    assert outbox_mail.attempts == 0
+    assert outbox_mail.claim is None
+    assert send() == 0
+
+
+def test_refused_connection_backs_off_then_redelivers(smtp, monkeypatch):
+    inbox, port = smtp
+    monkeypatch.setitem(shop.app.config, "MAIL_RETRY_DELAY", 1)
+    outbox_mail_id = enqueue("retried")
+
+    monkeypatch.setattr(shop.app.extensions["mail"], "port", free_port())
+    before = datetime.utcnow()
+    assert send() == 0
+    after = datetime.utcnow()
+    outbox_mail = load(outbox_mail_id)
+    assert outbox_mail.sent_at is None
+    assert outbox_mail.attempts == 1
+    assert outbox_mail.claim is None
+    assert outbox_mail.last_error
+    delay = timedelta(seconds=1)
+    assert before + delay <= outbox_mail.next_attempt <= after + delay
+
+    # NOTE : the server is back, but the mail is not due before its backoff
+    monkeypatch.setattr(shop.app.extensions["mail"], "port", port)
+    assert send() == 0
+    assert inbox.envelopes == []
+
+    time.sleep((outbox_mail.next_attempt - datetime.utcnow()).total_seconds() + 0.1)
+    assert send() == 1
+    assert len(inbox.envelopes) == 1
+    outbox_mail = load(outbox_mail_id)
+    assert outbox_mail.sent_at is not None
+    assert outbox_mail.attempts == 1
+    assert outbox_mail.claim is None
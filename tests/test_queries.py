@@ -0,0 +1,161 @@
+import pytest
+from sqlalchemy import event
+
+from conftest import clear_caches, login, make_user, shop
+
+PAGES = ["/home", "/profile/{user_id}", "/likes", "/myitems", "/item/{item_id}"]
+
+
+def grow(db, viewer, size):
+    """Add size vendors with size items each, all liked, followed and traded."""
+    with shop.app.app_context():
+        add_vendors(db, db.session.merge(viewer), size)
+
+
+def add_vendors(db, viewer, size):
+    vendors = [make_user() for _ in range(size)]
+    db.session.add_all(vendors)
+    db.session.flush()
+    items = [
+        shop.Item(
+            user_id=vendor.id,
+            name=f"fish {index}",
+            description="a fish",
+            category="Fish",
+            base_price=1 + index,
+        )
+        for vendor in vendors
+        for index in range(size)
+    ]
+    listed = [
+        shop.Item(
+            user_id=viewer.id,
+            name=f"tank {index}",
+            description="a tank",
+            category="Tank",
+            base_price=1 + index,
+        )
+        for index in range(size)
+    ]
+    db.session.add_all(items + listed)
+    db.session.flush()
+    db.session.add_all(
+        shop.ItemLike(user_id=viewer.id, item_id=item.id) for item in items
+    )
+    for vendor, bought, sold in zip(vendors, items[::size], listed):
+        db.session.add(shop.UserFollow(user_id=viewer.id, recipient_id=vendor.id))
+        db.session.add(shop.UserFollow(user_id=vendor.id, recipient_id=viewer.id))
+        for buyer, seller, item in ((viewer, vendor, bought), (vendor, viewer, sold)):
+            item.status = "bought"
+            transaction = shop.Transaction(
+                user_id=buyer.id, item_id=item.id, vendor_id=seller.id, value=1
+            )
+            db.session.add(transaction)
+            db.session.flush()
+            db.session.add(
+                shop.Review(
+                    transaction_id=transaction.id,
+                    user_id=buyer.id,
+                    recipient_id=seller.id,
+                    rating=5,
+                    comment="great",
+                )
+            )
+    db.session.commit()
+    shop.rebuild_reputation()
+    shop.rebuild_recommendations()
+
+
+def count_queries(db, client, url, method="GET", **kwargs):
+    clear_caches()
+    statements = []
+
+    def record(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    with shop.app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.open(url, method=method, **kwargs)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize("page", PAGES)
+def test_query_count_does_not_grow_with_data(database, page):
+    with shop.app.app_context():
+        viewer = make_user()
+        database.session.add(viewer)
+        database.session.flush()
+        # NOTE : the viewer's own listing, liked so it shares a user with every
+        # item the viewer likes and gets similar items once they exist
+        item = shop.Item(
+            user_id=viewer.id,
+            name="pond",
+            description="a pond",
+            category="Tank",
+            base_price=1,
+        )
+        database.session.add(item)
+        database.session.flush()
+        database.session.add(shop.ItemLike(user_id=viewer.id, item_id=item.id))
+        database.session.commit()
+    url = page.format(user_id=viewer.id, item_id=item.id)
+    client = shop.app.test_client()
+    login(client, viewer.id)
+
+    grow(database, viewer, 2)
+    small = count_queries(database, client, url)
+    grow(database, viewer, 8)
+    large = count_queries(database, client, url)
+    assert small == large
+
+
+def test_bulk_follow_statement_count_does_not_grow(database):
+    counts = []
+    for size in (2, 8):
+        with shop.app.app_context():
+            viewer = make_user()
+            vendors = [make_user() for _ in range(size)]
+            database.session.add_all([viewer, *vendors])
+            database.session.flush()
+            add_vendors(database, vendors[0], size)
+            vendor_ids = [vendor.id for vendor in vendors]
+        client = shop.app.test_client()
+        login(client, viewer.id)
+        url = "/api/v1/follows"
+        counts.append(
+            count_queries(database, client, url, "POST", json={"follow": vendor_ids})
+        )
+        with shop.app.app_context():
+            backfilled = shop.FeedEntry.query.filter_by(user_id=viewer.id).count()
+        assert backfilled == size  # the listings of vendors[0]
+    assert counts[0] == counts[1]
+
+
+def test_bulk_like_statement_count_does_not_grow(database):
+    counts = []
+    for size in (2, 8):
+        with shop.app.app_context():
+            viewer, vendor = make_user(), make_user()
+            database.session.add_all([viewer, vendor])
+            database.session.flush()
+            add_vendors(database, vendor, size)
+            item_ids = [
+                item.id for item in shop.Item.query.filter_by(user_id=vendor.id)
+            ]
+        client = shop.app.test_client()
+        login(client, viewer.id)
+        for action in ("like", "unlike"):
+            counts.append(
+                count_queries(
+                    database, client, "/api/v1/likes", "POST", json={action: item_ids}
+                )
+            )
+        with shop.app.app_context():
+            liked = shop.ItemLike.query.filter_by(user_id=viewer.id).count()
+        assert liked == 0
+    assert counts[:2] == counts[2:]